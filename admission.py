@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+
+import metrics
+import transport
+
+#------configuration------
+ADMISSION_ENABLED = True
+DEPTH_CHECK_INTERVAL = 1.0 # seconds between two reads of the lane depths (never per request)
+MAX_QUEUE_WAIT = 30 # seconds a newly accepted job may expect to wait in its lane
+MIN_LANE_DEPTH = 50 # jobs always accepted in a lane, whatever its measured throughput
+MAX_LANE_DEPTH = 20000 # jobs never exceeded in a lane, whatever its measured throughput
+THROUGHPUT_SMOOTHING = 0.3 # weight of the last interval in the throughput average
+STALE_AFTER = 10 # seconds without a measurement after which every job is accepted again
+RETRY_AFTER_MAX = 60 # longest Retry-After sent to a client, in seconds
+# Per client token bucket: (jobs per second, burst), None for no quota. A client is
+# the X-Client-Id request header, or the remote address without one
+CLIENT_QUOTA = None
+CLIENT_QUOTA_OVERRIDES = {} # client -> (jobs per second, burst)
+#-------------------------
+
+class Rejected(Exception):
+    """ The job is not admitted; retry_after is a hint in seconds"""
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, min(int(math.ceil(retry_after)), RETRY_AFTER_MAX))
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait(self, count=1):
+        """ Seconds until count tokens are available, 0 if they are. A batch larger
+        than the burst needs a full bucket and leaves it in debt"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(count, self.burst)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate if self.rate > 0 else RETRY_AFTER_MAX
+
+    def take(self, count=1):
+        """ Take count tokens, or return the seconds to wait for them"""
+        wait = self.wait(count)
+        if not wait:
+            self.tokens -= count
+        return wait
+
+class Lane:
+    """ What the pump knows of one lane: its depth at the last measurement, the
+    jobs it published since, and the rate at which the filters drain it"""
+    def __init__(self, name):
+        self.name = name
+        self.depth = 0
+        self.published = 0 # since the last measurement
+        self.throughput = None # jobs per second, None until measured twice
+        self.measured_at = None
+
+    def limit(self):
+        """ Depth at which a new job would wait longer than MAX_QUEUE_WAIT"""
+        if not self.throughput:
+            return MAX_LANE_DEPTH if self.throughput is None else MIN_LANE_DEPTH
+        return min(max(self.throughput * MAX_QUEUE_WAIT, MIN_LANE_DEPTH), MAX_LANE_DEPTH)
+
+    def update(self, depth, now):
+        # an idle lane drains nothing because it holds nothing, not because the
+        # filters are slow: its interval says nothing about the throughput
+        if self.measured_at is not None and now > self.measured_at and self.depth + self.published:
+            # what left the queue: it held depth + published, it holds depth now. A job
+            # counted in published but not queued yet makes one interval high and the
+            # next one low, the average evens them out
+            drained = (self.depth + self.published - depth) / (now - self.measured_at)
+            self.throughput = max(drained if self.throughput is None else (
+                THROUGHPUT_SMOOTHING * drained + (1 - THROUGHPUT_SMOOTHING) * self.throughput), 0.0)
+        self.depth = depth
+        self.published = 0
+        self.measured_at = now
+
+class Admission:
+    """ Admission control of the pump. A background thread reads the depth of the
+    upload lanes every DEPTH_CHECK_INTERVAL seconds; requests only read these
+    cached values. A job is refused when its lane is deeper than the filters can
+    drain in MAX_QUEUE_WAIT seconds (so the accepted jobs keep a bounded wait), or
+    when its client is over its quota. Other pumps' jobs only show up at the next
+    measurement, which makes the throughput estimate err on the low side"""
+
+    def __init__(self, lanes, host=transport.RABBITMQ_HOST):
+        self.host = host
+        self.lanes = {name: Lane(name) for name in lanes}
+        self._clients = {} # client -> TokenBucket
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if ADMISSION_ENABLED and self._thread is None:
+            self._thread = threading.Thread(target=self._measure_loop, daemon=True)
+            self._thread.start()
+
+    def _measure_loop(self):
+        while True:
+            try:
+                broker = transport.connect(self.host)
+                try:
+                    for name in self.lanes:
+                        broker.declare(name)
+                    while True:
+                        self.measure(broker)
+                        time.sleep(DEPTH_CHECK_INTERVAL)
+                finally:
+                    broker.close()
+            except transport.CONNECTION_ERRORS:
+                print("Admission: unable to connect to the message broker, retrying in 5 seconds...")
+                time.sleep(5)
+            except Exception as e:
+                # the lane limits go stale (STALE_AFTER) until the measurements resume
+                print(f"Admission: {e!r}, restarting in 5 seconds...")
+                time.sleep(5)
+
+    def measure(self, broker):
+        depths = {name: broker.queue_depth(name) for name in self.lanes}
+        now = time.monotonic()
+        with self._lock:
+            for name, depth in depths.items():
+                lane = self.lanes[name]
+                lane.update(depth, now)
+                metrics.QUEUE_DEPTH.set(depth, stage=name)
+
+    def _lane_wait(self, lane, count):
+        """ Seconds until lane takes count more jobs, 0 if it takes them now"""
+        if lane.measured_at is None or time.monotonic() - lane.measured_at > STALE_AFTER:
+            return 0 # no measurement: the publish itself reports a broker in trouble
+        if lane.depth + lane.published == 0:
+            return 0 # an empty lane takes a batch of any size
+        excess = lane.depth + lane.published + count - lane.limit()
+        if excess <= 0:
+            return 0
+        return excess / lane.throughput if lane.throughput else RETRY_AFTER_MAX
+
+    def _bucket(self, client):
+        quota = CLIENT_QUOTA_OVERRIDES.get(client, CLIENT_QUOTA)
+        if quota is None:
+            return None
+        bucket = self._clients.get(client)
+        if bucket is None:
+            if len(self._clients) > 10000:
+                # forget the full buckets, they behave like new ones
+                self._clients = {c: b for c, b in self._clients.items() if b.tokens < b.burst}
+            bucket = self._clients[client] = TokenBucket(*quota)
+        return bucket
+
+    def check(self, client):
+        """ Cheap test before an upload body is read: raises Rejected when the
+        client is out of tokens or no lane takes a job"""
+        if not ADMISSION_ENABLED:
+            return
+        with self._lock:
+            bucket = self._bucket(client)
+            wait = bucket.wait() if bucket is not None else 0
+            if wait:
+                raise Rejected(f"Client {client} is over its quota", wait)
+            waits = [self._lane_wait(lane, 1) for lane in self.lanes.values()]
+            if waits and min(waits) > 0:
+                raise Rejected("The pipeline is overloaded", min(waits))
+
+    def admit(self, client, lanes):
+        """ Take the jobs going to lanes (one entry per job) or raise Rejected.
+        All of them are admitted or none"""
+        if not ADMISSION_ENABLED:
+            return
+        counts = {}
+        for name in lanes:
+            counts[name] = counts.get(name, 0) + 1
+        with self._lock:
+            waits = [self._lane_wait(self.lanes[name], count) for name, count in counts.items()]
+            if waits and max(waits) > 0:
+                raise Rejected("The pipeline is overloaded", max(waits))
+            bucket = self._bucket(client)
+            if bucket is not None:
+                wait = bucket.take(len(lanes))
+                if wait:
+                    raise Rejected(f"Client {client} is over its quota", wait)
+            for name, count in counts.items():
+                self.lanes[name].published += count
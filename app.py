@@ -1,64 +1,379 @@
 import os
 import uuid
+import shutil
+import tarfile
+import tempfile
+import zipfile
 from flask import Flask, request, jsonify, send_from_directory
-import pika
+from werkzeug.formparser import parse_form_data
 import json
+import time
+import metrics
+import transport
+import ingest
+import job_store
+import storage
+import tracing
+import admission
+from publisher import PublishError, PublishRejected
 
 #----- COnfiguration -----#
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 RABBITMQ_HOST = 'localhost'
-UPLOAD_QUEUE = 'upload_queue'
+UPLOAD_LANES = ingest.LANES # upload_queue, or upload_bulk_queue for large images (see ingest.py)
+PUBLISHER_POOL_SIZE = 4 # long-lived RabbitMQ connections shared by requests
+JOB_DB = job_store.JOB_DB # status of the jobs, fed by the completion events of final_queue
+JOB_WAIT_MAX = 60 # longest a GET /jobs/<id>?wait= request is held, in seconds
+RESULT_MAX_AGE = 3600 # results never change once written, let clients cache them
+# Archive members with other extensions (READMEs, folders, ...) are skipped
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tif', 'tiff', 'webp'}
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Connections are kept open between requests and the queue is declared once per connection.
+# RabbitMQ by default, or the local queues with PIPELINE_TRANSPORT=local (see transport.py)
+publisher_pool = transport.make_publisher(UPLOAD_LANES, host=RABBITMQ_HOST, size=PUBLISHER_POOL_SIZE)
+# Jobs are looked up here instead of clients polling the output folder
+jobs = job_store.JobStore(JOB_DB)
+# deletes the files a job passed between the filters once it is finished (see storage.py)
+reaper = storage.Reaper()
+job_store.start_event_consumer(jobs, host=RABBITMQ_HOST, reaper=reaper)
+# refuses uploads the pipeline cannot take in time, from the lane depths read in the background
+admission_control = admission.Admission(UPLOAD_LANES, host=RABBITMQ_HOST)
+admission_control.start()
+
+#------Helpers -----#
+def new_upload_path(filename):
+    """ Generate a unique file name (keeping the extension) and its sharded path
+    inside the upload folder"""
+    ext=filename.split('.')[-1]
+    unique_filename=f"{str(uuid.uuid4())}.{ext}"
+    return unique_filename, storage.path(app.config['UPLOAD_FOLDER'],unique_filename)
+
+def new_job(unique_filename, file_path):
+    """ Job message for a saved upload, with its header (format, size, mode: see
+    ingest.probe) and the cost read from it. Returns (lane, message), or (None, None)
+    when the file is not an image Pillow can read: it is deleted, and never queued"""
+    with metrics.timed('pump', 'probe'):
+        info = ingest.probe(file_path)
+    if info is None:
+        os.remove(file_path)
+        return None, None
+    cost = ingest.job_cost(info)
+    return ingest.lane_for(cost), {
+        'image_id': unique_filename,
+        'original_path': file_path,
+        'cost': cost,
+        'probe': info,
+        'intermediates': [file_path] if storage.REAP_UPLOADS else []
+    }
+
+def trace_pump(trace, job_message, started_at, phases):
+    """ Record the pump's span of a job (the root of its trace) and its phases:
+    [(name, start, seconds)]"""
+    trace_id, span_id = trace
+    image_id = job_message['image_id']
+    spans = [tracing.span(trace_id, span_id, None, image_id, 'pump', 'stage',
+                          started_at, time.time() - started_at)]
+    spans.extend(tracing.span(trace_id, tracing.new_id(), span_id, image_id, 'pump', name, start, seconds)
+                 for name, start, seconds in phases)
+    tracing.record(spans)
+
+def client_id():
+    """ Who an upload is counted against for the quotas (see admission.py)"""
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+def too_busy(rejected, **body):
+    """ 429 response telling the client when to retry, body holds more fields"""
+    return (jsonify({'error': rejected.reason, 'retry_after': rejected.retry_after, **body}), 429,
+            {'Retry-After': str(rejected.retry_after)})
+
+def is_image_name(filename):
+    return '.' in filename and filename.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS
+
+def save_multipart_stream():
+    """ Parse a multipart body, writing every file part straight into the upload
+    folder while it is received (instead of buffering it first). A part is written
+    under a temporary name and renamed once the whole body is parsed"""
+    saved = []
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        unique_filename, file_path = new_upload_path(filename or 'upload')
+        tmp = storage.temp_path(file_path)
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        f = open(tmp, 'wb+')
+        saved.append((filename, unique_filename, file_path, tmp, f))
+        return f
+    try:
+        parse_form_data(request.environ, stream_factory=stream_factory,
+                        max_content_length=app.config.get('MAX_CONTENT_LENGTH'))
+    except BaseException:
+        for *_, f in saved:
+            f.close()
+        storage.remove([tmp for _, _, _, tmp, _ in saved])
+        raise
+    # every part, several of them may share a field name
+    for *_, f in saved:
+        f.close()
+    uploads = []
+    for filename, unique_filename, file_path, tmp, _ in saved:
+        if not filename:
+            os.remove(tmp) # empty file input
+            continue
+        os.replace(tmp, file_path)
+        uploads.append((unique_filename, file_path, filename))
+    return uploads, []
+
+def save_archive_member(name, fileobj, uploads, skipped):
+    if not is_image_name(name):
+        skipped.append(name)
+        return
+    # Only the extension of the member name is used, never its path
+    unique_filename, file_path = new_upload_path(os.path.basename(name))
+    with storage.atomic_path(file_path) as tmp, open(tmp, 'wb') as out:
+        shutil.copyfileobj(fileobj, out)
+    uploads.append((unique_filename, file_path, name))
+
+def save_tar_stream():
+    """ Read a (optionally compressed) tar from the request body member by member"""
+    uploads, skipped = [], []
+    with tarfile.open(fileobj=request.stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                save_archive_member(member.name, archive.extractfile(member), uploads, skipped)
+    return uploads, skipped
+
+def save_zip_stream():
+    """ A zip index is at the end of the file, so the body is spooled to disk first"""
+    uploads, skipped = [], []
+    with tempfile.TemporaryFile(dir=app.config['UPLOAD_FOLDER']) as spool:
+        shutil.copyfileobj(request.stream, spool)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        save_archive_member(info.filename, member, uploads, skipped)
+    return uploads, skipped
+
+#------Metrics -----#
+UPLOAD_ENDPOINTS = ('upload_file', 'upload_batch')
+
+@app.before_request
+def track_in_flight():
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        metrics.IN_FLIGHT.inc(stage='pump')
+
+@app.teardown_request
+def untrack_in_flight(exc):
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        metrics.IN_FLIGHT.dec(stage='pump')
+
+@app.after_request
+def count_uploads(response):
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        outcome = 'ok' if response.status_code < 400 else f"http_{response.status_code}"
+        metrics.JOBS.inc(stage='pump', outcome=outcome)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """ Pump metrics in the Prometheus text format """
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
 #------The API Endpoints -----#
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """ Accepts an image uploade and sends a job message to Rabbit MQ  """
+    # refused before the body is read when the pipeline is already full
+    client = client_id()
+    try:
+        admission_control.check(client)
+    except admission.Rejected as e:
+        return too_busy(e)
     if 'file' not in request.files:
         return jsonify({'error': 'No file found'}),400
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}),400
-    
     file =request.files['file']
     if file:
+        #every job is traced from here to the last filter (see tracing.py)
+        trace = tracing.new_trace()
+        started_at = time.time()
         #generate unique id to save file
-        ext=file.filename.split('.')[-1]
-        unique_filename=f"{str(uuid.uuid4())}.{ext}"
-        file_path=os.path.join(app.config['UPLOAD_FOLDER'],unique_filename)
-        file.save(file_path)    
-
-        #generate the job message
-        job_message={
-            'image_id':unique_filename,
-            'original_path':file_path
-        }
+        unique_filename, file_path = new_upload_path(file.filename)
+        with metrics.timed('pump', 'save'), storage.atomic_path(file_path) as tmp:
+            file.save(tmp)
+
+        #generate the job message, and pick its lane from the image header
+        saved_at = time.time()
+        lane, job_message = new_job(unique_filename, file_path)
+        if job_message is None:
+            return jsonify({'error': 'The file is not a readable image'}), 400
+        try:
+            admission_control.admit(client, [lane])
+        except admission.Rejected as e:
+            os.remove(file_path)
+            return too_busy(e)
+        published = False
         try:
-            #connect to rabbit mq and publish the  message
-            connection=pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST)    
-                                               )
-            channel=connection.channel()
-            channel.queue_declare(queue=UPLOAD_QUEUE,durable=True)
-            channel.basic_publish(
-                exchange='',
-                routing_key=UPLOAD_QUEUE,
-                body=json.dumps(job_message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ))
-            connection.close()
+            #publish the message on a pooled connection and wait for the broker confirm
+            with metrics.timed('pump', 'publish'):
+                # lets the first filter measure how long the job waited in the queue
+                job_message['enqueued_at'] = time.time()
+                publisher_pool.publish(lane, json.dumps(job_message), headers=tracing.headers(*trace))
+            published = True
+            jobs.submitted([(lane, job_message)])
+            enqueued_at = job_message['enqueued_at']
+            trace_pump(trace, job_message, started_at, [
+                ('save', started_at, saved_at - started_at),
+                ('probe', saved_at, enqueued_at - saved_at),
+                ('publish', enqueued_at, time.time() - enqueued_at)])
 
             print(f" [x] Sent {job_message}")
             return jsonify({'message': 'File uploaded successfully', 'job': job_message}), 200
-        except pika.exceptions.AMQPConnectionError:
-            
-            return jsonify({'error': 'Failed to connect to RabbitMQ'}), 503
+        except transport.CONNECTION_ERRORS:
+            return jsonify({'error': 'Failed to connect to the message broker'}), 503
+        except PublishRejected:
+            # the lane is at its broker-side length limit (see publisher.QUEUE_MAX_LENGTH)
+            return too_busy(admission.Rejected("The upload queue is full", admission.MAX_QUEUE_WAIT))
+        except PublishError as e:
+            return jsonify({'error': f"RabbitMQ did not accept the job: {str(e)}"}), 503
         except Exception as e:
             return jsonify({'error': f"An unexpected error occured:{str(e)}"}), 503
-        
+        finally:
+            if not published:
+                os.remove(file_path) # no filter will read it
+
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """ Bulk ingestion: a multipart body with many files, or a tar / tar.gz / zip body.
+    Every image is written to disk as it arrives and all jobs are published in one
+    confirmed batch. Returns the job ids; when the broker fails part way, the ids of
+    the jobs published before it, the files of the others are deleted"""
+    content_type = request.mimetype
+    if content_type == 'multipart/form-data':
+        save_body = save_multipart_stream
+    elif content_type in ('application/x-tar', 'application/gzip', 'application/x-gzip',
+                          'application/x-gtar', 'application/x-compressed-tar'):
+        save_body = save_tar_stream
+    elif content_type in ('application/zip', 'application/x-zip-compressed'):
+        save_body = save_zip_stream
+    else:
+        return jsonify({'error': f"Unsupported content type: {content_type}"}), 415
+    client = client_id()
+    try:
+        admission_control.check(client)
+    except admission.Rejected as e:
+        return too_busy(e)
+    try:
+        with metrics.timed('pump', 'save'):
+            uploads, skipped = save_body()
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        return jsonify({'error': f"Invalid archive: {str(e)}"}), 400
+    if not uploads:
+        return jsonify({'error': 'No file found', 'skipped': skipped}), 400
+
+    jobs_by_lane = []
+    for unique_filename, file_path, name in uploads:
+        lane, job_message = new_job(unique_filename, file_path)
+        if job_message is None:
+            skipped.append(name) # unreadable image
+        else:
+            jobs_by_lane.append((lane, job_message))
+    if not jobs_by_lane:
+        return jsonify({'error': 'No readable image found', 'skipped': skipped}), 400
+    try:
+        # all or nothing: a client retries the whole batch
+        admission_control.admit(client, [lane for lane, _ in jobs_by_lane])
+    except admission.Rejected as e:
+        storage.remove([m['original_path'] for _, m in jobs_by_lane])
+        return too_busy(e)
+    traces = {m['image_id']: tracing.new_trace() for _, m in jobs_by_lane}
+    published = [] # (lane, job message) of the lanes the broker confirmed
+    error = None
+    enqueued_at = time.time()
+    try:
+        #one broker round-trip per lane for the whole batch
+        with metrics.timed('pump', 'publish'):
+            for _, m in jobs_by_lane:
+                m['enqueued_at'] = enqueued_at
+            for lane in UPLOAD_LANES:
+                lane_jobs = [(l, m) for l, m in jobs_by_lane if l == lane]
+                if lane_jobs:
+                    publisher_pool.publish_batch(
+                        lane, [json.dumps(m) for _, m in lane_jobs],
+                        headers=[tracing.headers(*traces[m['image_id']]) for _, m in lane_jobs])
+                    published.extend(lane_jobs)
+    except transport.CONNECTION_ERRORS:
+        error = 'Failed to connect to the message broker'
+    except PublishRejected:
+        error = admission.Rejected("The upload queue is full", admission.MAX_QUEUE_WAIT)
+    except PublishError as e:
+        error = f"RabbitMQ did not accept the jobs: {str(e)}"
+    except Exception as e:
+        error = f"An unexpected error occured:{str(e)}"
+    # no filter will read the uploads of the jobs that were not published
+    sent = {m['image_id'] for _, m in published}
+    storage.remove([m['original_path'] for _, m in jobs_by_lane if m['image_id'] not in sent])
+    job_ids = [m['image_id'] for _, m in published]
+    if published:
+        jobs.submitted(published)
+        elapsed = time.time() - enqueued_at
+        for _, m in published:
+            trace_pump(traces[m['image_id']], m, enqueued_at, [('publish', enqueued_at, elapsed)])
+        print(f" [x] Sent {len(published)} jobs")
+    if isinstance(error, admission.Rejected):
+        return too_busy(error, job_ids=job_ids, skipped=skipped)
+    if error is not None:
+        return jsonify({'error': error, 'job_ids': job_ids, 'skipped': skipped}), 503
+    return jsonify({'message': f"{len(published)} files uploaded successfully",
+                    'job_ids': job_ids,
+                    'skipped': skipped}), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """ Status of a job: queued, done or failed, with its results once done.
+    With ?wait=<seconds> the request is held until the job is finished (long poll),
+    so a client needs one request instead of polling"""
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_WAIT_MAX)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    job = jobs.wait(job_id, wait) if wait > 0 else jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    for result in job['results']:
+        query = [f"{key}={result[key]}" for key in ('width', 'branch') if result.get(key)]
+        result['url'] = f"/results/{job_id}" + ('?' + '&'.join(query) if query else '')
+    return jsonify(job), 200
+
+@app.route('/results/<job_id>', methods=['GET'])
+def job_result(job_id):
+    """ The final image of a finished job (?width= picks a rendition, ?branch= the
+    branch of a pipeline with fan-out, see pipeline.py).
+    Served from the file with ETag / Last-Modified, so a client re-downloading it gets a
+    304, and with Range requests for partial downloads. Under a server that provides
+    wsgi.file_wrapper (gunicorn, ...) the file is sent with sendfile, without copies
+    through Python"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job['status'] not in job_store.FINAL_STATUSES:
+        return jsonify({'error': 'Job not finished', 'status': job['status']}), 404
+    width = request.args.get('width', type=int)
+    branch = request.args.get('branch')
+    results = [r for r in job['results'] if (width is None or r['width'] == width)
+               and (branch is None or r.get('branch') == branch)]
+    if not results:
+        return jsonify({'error': 'No result for this job', 'status': job['status']}), 404
+    # the main rendition carries the job's own name
+    result = next((r for r in results if r['name'] == job_id), results[0])
+    # the path was written by the last filter, the name is checked against it
+    folder, name = os.path.split(os.path.abspath(result['path']))
+    return send_from_directory(folder, name, conditional=True, etag=True, max_age=RESULT_MAX_AGE)
 
 #-----Run the Flask App -----#
 if __name__ == '__main__':  
@@ -0,0 +1,217 @@
+import argparse
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import bench_resize
+import ingest
+import resize_filter
+import storage
+import water_filter
+
+# Benchmark configuration
+UPLOAD_URL = 'http://localhost:5001/upload'
+METRICS_URL = 'http://localhost:5001/metrics'
+# (width, height) of the generated test images and how often each is picked
+IMAGE_MIX = [((800, 600), 5), ((1920, 1080), 3), ((4000, 3000), 2), ((6000, 4000), 1)]
+RESULT_TIMEOUT = 300 # seconds to wait for the last final output
+
+PYTHON_CMD = sys.executable
+
+def make_test_images(folder):
+    """Writes one camera-like JPEG per size in IMAGE_MIX, returns [(path, weight)]."""
+    images = []
+    for (w, h), weight in IMAGE_MIX:
+        path = os.path.join(folder, f"{w}x{h}.jpg")
+        bench_resize.test_image((w, h)).save(path, quality=90)
+        images.append((path, weight))
+    return images
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    # nearest-rank percentile
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+def start_process(args, env=None):
+    return subprocess.Popen([PYTHON_CMD] + args, stdout=subprocess.DEVNULL,
+                            env=dict(os.environ, **env) if env else None)
+
+def start_filter(module, workers, cache=False):
+    """Starts one filter process with the given pool size. The result cache is off by
+    default, otherwise repeated uploads of the same test images would be cache hits.
+    It is switched in the environment, which the pool workers inherit."""
+    code = (f"import {module} as f; f.WORKER_COUNT = {workers}; "
+            f"f.PREFETCH_COUNT = {2 * workers}; f.main()")
+    return start_process(['-c', code], env={'PIPELINE_RESULT_CACHE': '1' if cache else '0'})
+
+def wait_for_pump(timeout=30):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            requests.get(METRICS_URL, timeout=1)
+            return True
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    return False
+
+def upload(path):
+    """Uploads one image, returns (job id, send time, cost) or None."""
+    sent = time.time()
+    with open(path, 'rb') as f:
+        response = requests.post(UPLOAD_URL, files={'file': (os.path.basename(path), f, 'image/jpeg')})
+    if response.status_code != 200:
+        print(f"   Upload failed with {response.status_code}: {response.text[:200]}")
+        return None
+    job = response.json()['job']
+    return job['image_id'], sent, job.get('cost')
+
+def output_time(folder, job_id):
+    """mtime of a job's output file in a stage folder, or None if not written yet."""
+    try:
+        return os.stat(storage.path(folder, job_id)).st_mtime
+    except FileNotFoundError:
+        return None
+
+def wait_for_results(job_ids, timeout=RESULT_TIMEOUT):
+    """Waits until every job has its final (watermarked) file. Unlike polling queue
+    lengths this also covers jobs that are in flight or unacked in a filter."""
+    pending = set(job_ids)
+    start = time.time()
+    while pending and time.time() - start < timeout:
+        pending = {j for j in pending if output_time(water_filter.WATERMARK_FOLDER, j) is None}
+        if pending:
+            time.sleep(0.05)
+    return not pending
+
+def run_load(images, count, clients):
+    """Uploads `count` images picked from the mix with `clients` concurrent clients."""
+    paths = [p for p, w in images for _ in range(w)]
+    picks = [random.choice(paths) for _ in range(count)]
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        return [r for r in pool.map(upload, picks) if r is not None]
+
+def report(jobs, started):
+    """Computes end-to-end and per-stage latencies from the output files."""
+    end_to_end, resize_stage, watermark_stage, small_jobs = [], [], [], []
+    finished = started
+    for job_id, sent, cost in jobs:
+        resized = output_time(resize_filter.RESIZE_FOLDER, job_id)
+        final = output_time(water_filter.WATERMARK_FOLDER, job_id)
+        if final is None:
+            continue
+        finished = max(finished, final)
+        end_to_end.append(final - sent)
+        if ingest.lane_for(cost) == ingest.SMALL_LANE:
+            small_jobs.append(final - sent)
+        if resized is not None:
+            resize_stage.append(resized - sent)
+            watermark_stage.append(final - resized)
+    duration = finished - started
+    return {
+        'completed': len(end_to_end),
+        'duration': duration,
+        'throughput': len(end_to_end) / duration if duration > 0 else float('nan'),
+        'end_to_end': end_to_end,
+        'resize': resize_stage,
+        'watermark': watermark_stage,
+        'small': small_jobs,
+    }
+
+def run_config(workers, resize_processes, images, count, clients, cache=False):
+    """Runs one configuration: starts the filters, drives the load, stops the filters."""
+    print(f"\n--- {resize_processes} resize process(es) x {workers} worker(s) ---")
+    filters = [start_filter('resize_filter', workers, cache) for _ in range(resize_processes)]
+    filters.append(start_filter('water_filter', workers, cache))
+    try:
+        time.sleep(2) # let the consumers attach before the load starts
+        started = time.time()
+        jobs = run_load(images, count, clients)
+        print(f"   Uploaded {len(jobs)}/{count} images, waiting for results...")
+        if not wait_for_results([j for j, _, _ in jobs]):
+            print("   WARNING: timeout, some jobs did not finish")
+        return report(jobs, started)
+    finally:
+        for f in filters:
+            f.terminate()
+        for f in filters:
+            f.wait()
+
+def print_results(results):
+    print("\n" + "="*90)
+    print(" BENCHMARK RESULTS (latencies in seconds)")
+    print("="*90)
+    print(f" {'config':<14}{'done':>6}{'img/s':>8}"
+          f"{'e2e p50':>9}{'p95':>7}{'p99':>7}"
+          f"{'resize p50':>12}{'p95':>7}{'p99':>7}"
+          f"{'wmark p50':>11}{'p95':>7}{'p99':>7}")
+    for name, r in results:
+        cells = []
+        for key in ('end_to_end', 'resize', 'watermark'):
+            cells.extend(percentile(r[key], p) for p in (50, 95, 99))
+        print(f" {name:<14}{r['completed']:>6}{r['throughput']:>8.2f}"
+              f"{cells[0]:>9.2f}{cells[1]:>7.2f}{cells[2]:>7.2f}"
+              f"{cells[3]:>12.2f}{cells[4]:>7.2f}{cells[5]:>7.2f}"
+              f"{cells[6]:>11.2f}{cells[7]:>7.2f}{cells[8]:>7.2f}")
+    print("\n End-to-end latency of the jobs in the small lane (see ingest.py):")
+    for name, r in results:
+        small = [percentile(r['small'], p) for p in (50, 95, 99)]
+        print(f" {name:<14}{len(r['small']):>6} jobs   p50 {small[0]:.2f}  p95 {small[1]:.2f}  p99 {small[2]:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput / latency benchmark of the pipeline")
+    parser.add_argument('--images', type=int, default=50, help="uploads per configuration")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent upload clients")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help="pool sizes per filter process to compare")
+    parser.add_argument('--resize-processes', type=int, default=1,
+                        help="resize filter processes per configuration")
+    parser.add_argument('--start-pump', action='store_true', help="start app.py for the run")
+    parser.add_argument('--cache', action='store_true', help="keep the stage result cache on")
+    parser.add_argument('--transport', choices=['rabbitmq', 'local'], default=None,
+                        help="backend for the processes started here; 'local' starts "
+                             "local_broker.py so no external service is needed")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    broker = None
+    if args.transport:
+        # inherited by the pump and the filters started below
+        os.environ['PIPELINE_TRANSPORT'] = args.transport
+    if args.transport == 'local':
+        broker = start_process(['local_broker.py'])
+        time.sleep(1)
+    pump = start_process(['app.py']) if args.start_pump else None
+    try:
+        if not wait_for_pump():
+            print(f" ERROR: Cannot reach the pump at '{UPLOAD_URL}'. Run 'python app.py' or pass --start-pump.")
+            sys.exit(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            images = make_test_images(tmp)
+            print(f" Image mix: {', '.join(f'{w}x{h} x{n}' for (w, h), n in IMAGE_MIX)}")
+            results = []
+            for workers in args.workers:
+                r = run_config(workers, args.resize_processes, images, args.images, args.clients,
+                               args.cache)
+                results.append((f"{args.resize_processes}p x {workers}w", r))
+        print_results(results)
+    finally:
+        for process in (pump, broker):
+            if process is not None:
+                process.terminate()
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nBenchmark stopped by user.")
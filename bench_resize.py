@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+import tempfile
+from PIL import Image
+
+import resize_filter
+
+# Benchmark configuration
+TEST_IMAGE_PATH = None # None = generate a 24 megapixel JPEG
+GENERATED_SIZE = (6000, 4000)
+ITERATIONS = 5
+QUALITIES = ['best', 'balanced', 'fast']
+
+PYTHON_CMD = sys.executable
+
+def test_image(size=GENERATED_SIZE):
+    """A camera-like image (gradients + noise), already decoded. Shared by the
+    other benchmarks."""
+    w, h = size
+    return Image.merge('RGB', [
+        Image.linear_gradient('L').resize((w, h)),
+        Image.effect_noise((w, h), 40),
+        Image.radial_gradient('L').resize((w, h)),
+    ])
+
+def make_test_image(path, size=GENERATED_SIZE):
+    """Writes a camera-like JPEG of the given size to path."""
+    test_image(size).save(path, quality=90)
+    print(f" Generated {size[0]}x{size[1]} test image at {path}")
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return peak / 1024
+
+def run_child(path, quality):
+    """Runs decode+resize ITERATIONS times in this process and prints a JSON result."""
+    base_rss = peak_rss_mb()
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        with Image.open(path) as img:
+            out = resize_filter.resize(img, resize_filter.RESIZE_WIDTH, quality)
+            out.load()
+        timings.append(time.perf_counter() - start)
+    print(json.dumps({
+        'quality': quality,
+        'best_ms': min(timings) * 1000,
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+        'base_rss_mb': base_rss,
+        'size': list(out.size),
+    }))
+
+def run_quality(path, quality):
+    """Runs one quality setting in a fresh process so peak RSS is not shared."""
+    output = subprocess.check_output([PYTHON_CMD, __file__, '--child', path, quality])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    print("\n" + "="*50)
+    print(" BENCHMARK: DECODE + RESIZE")
+    print("="*50)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = TEST_IMAGE_PATH
+        if path is None:
+            path = os.path.join(tmp, 'bench.jpg')
+            make_test_image(path)
+        with Image.open(path) as img:
+            print(f" Input: {path} {img.size[0]}x{img.size[1]} {img.format}")
+        print(f" Target width: {resize_filter.RESIZE_WIDTH}, {ITERATIONS} iterations per setting\n")
+
+        results = [run_quality(path, quality) for quality in QUALITIES]
+
+    print(f" {'quality':<10}{'best ms':>10}{'mean ms':>10}{'peak RSS MB':>14}{'speedup':>10}")
+    baseline = results[0]['mean_ms']
+    for r in results:
+        print(f" {r['quality']:<10}{r['best_ms']:>10.1f}{r['mean_ms']:>10.1f}"
+              f"{r['peak_rss_mb']:>14.1f}{baseline / r['mean_ms']:>9.1f}x")
+    print(f"\n (Peak RSS includes ~{results[0]['base_rss_mb']:.0f} MB for the interpreter and Pillow.)")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+import strips
+import resize_filter
+import blur_filter
+import bench_resize
+
+# Benchmark configuration
+GENERATED_SIZE = (6000, 4000) # one large upload
+ITERATIONS = 3
+THREADS = sorted({1, 2, 4, os.cpu_count() or 1})
+BLUR_RADIUS = 20
+
+def best_ms(fn):
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+def main():
+    print("\n" + "="*56)
+    print(" BENCHMARK: ONE IMAGE SPLIT OVER STRIP THREADS")
+    print("="*56)
+    img = bench_resize.test_image(GENERATED_SIZE)
+    print(f" Input: {img.size[0]}x{img.size[1]}, {os.cpu_count()} core(s), best of {ITERATIONS}\n")
+    print(f" {'threads':>7}{'resize ms':>12}{'speedup':>9}{'blur ms':>12}{'speedup':>9}")
+    base = None
+    for threads in THREADS:
+        strips.set_strip_threads(threads)
+        resize_ms = best_ms(lambda: resize_filter.resize(img, resize_filter.RESIZE_WIDTH, 'best'))
+        blur_ms = best_ms(lambda: blur_filter.blur(img, BLUR_RADIUS, 'exact', None))
+        base = base or (resize_ms, blur_ms)
+        print(f" {threads:>7}{resize_ms:>12.1f}{base[0] / resize_ms:>8.1f}x"
+              f"{blur_ms:>12.1f}{base[1] / blur_ms:>8.1f}x")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nBenchmark stopped by user.")
+        sys.exit(0)
@@ -1,9 +1,16 @@
-import pika
-import json
+import math
 import os
 import sys
 import time
 from PIL import Image, ImageFilter
+import consumer
+import transport
+import result_cache
+import metrics
+import shm_handoff
+import storage
+import strips
+import resize_filter
 
 # --- Configuration ---
 RABBITMQ_HOST = 'localhost'
@@ -11,17 +18,115 @@ IN_QUEUE = 'blur_queue'
 OUT_QUEUE = 'watermark_queue'  
 BLUR_FOLDER = './blurred'
 BLUR_RADIUS = 5
+BLUR_ACCURACY = 'exact' # 'exact' (GaussianBlur), 'balanced' or 'fast'
+# accuracy -> (box blur passes, smallest radius worth a downsample)
+# Passes of a box blur with the same variance approximate the Gaussian (Pillow's own
+# GaussianBlur is 3 passes); fewer passes are faster but less smooth. Radii of at
+# least `min radius` times 2 are blurred on a copy reduced by radius // min radius
+# and scaled back up, which costs a fraction of the full-size blur.
+BLUR_ACCURACY_SETTINGS = {
+    'exact': (None, None),
+    'balanced': (3, 6.0),
+    'fast': (2, 3.0),
+}
+# Boxes to blur, as (left, top, right, bottom) fractions of the image size so one
+# mask fits every rendition, e.g. [(0.0, 0.8, 1.0, 1.0)]. None blurs the whole image
+BLUR_REGIONS = None
+# Concurrency of this filter process (see consumer.py)
+WORKER_COUNT = consumer.WORKER_COUNT
+WORKER_TYPE = consumer.WORKER_TYPE
+PREFETCH_COUNT = consumer.PREFETCH_COUNT
+METRICS_PORT = 9102 # http://localhost:9102/metrics
+MEMORY_BUDGET = consumer.WORKER_MEMORY_BUDGET # larger inputs are refused (checked on the header)
 
 # Ensure the output folder exists
 os.makedirs(BLUR_FOLDER, exist_ok=True)
 
+def make_cache():
+    """ Results are memoized by (input content, parameters above). Called again when
+    the parameters are changed at start-up (see pipeline.py)"""
+    return result_cache.StageCache('blur', {'radius': BLUR_RADIUS, 'accuracy': BLUR_ACCURACY,
+                                            'regions': BLUR_REGIONS})
+
+cache = make_cache()
+
+def box_blur(img, radius, passes):
+    """Approximates a Gaussian blur (radius = standard deviation) with `passes`
+    box blurs whose variances add up to the Gaussian's."""
+    if passes == 3:
+        # that is how Pillow implements GaussianBlur, in one call
+        return img.filter(ImageFilter.GaussianBlur(radius=radius))
+    box_radius = (math.sqrt(12.0 * radius * radius / passes + 1) - 1) / 2
+    for _ in range(passes):
+        img = img.filter(ImageFilter.BoxBlur(box_radius))
+    return img
+
+def blur_full(img, radius, accuracy=BLUR_ACCURACY):
+    """Blurs a whole in-memory image at the given accuracy."""
+    passes, min_radius = BLUR_ACCURACY_SETTINGS[accuracy]
+    if passes is None:
+        return img.filter(ImageFilter.GaussianBlur(radius=radius))
+    factor = int(radius // min_radius)
+    if factor < 2:
+        return box_blur(img, radius, passes)
+    # Downsample - blur - upsample. The box reduce and the bilinear upscale blur
+    # too, so their variance is taken off the blur done on the small copy.
+    extra = (factor * factor - 1) / 12.0 + factor * factor / 6.0
+    small = box_blur(img.reduce(factor), math.sqrt(max(radius * radius - extra, 0)) / factor, passes)
+    return small.resize(img.size, Image.Resampling.BILINEAR)
+
+def blur_parallel(img, radius, accuracy=BLUR_ACCURACY):
+    """Blurs overlapping strips on the strip threads. Each strip is blurred with
+    enough rows of context above and below that the stitched result has no seams.
+    When blur_full() blurs on a reduced copy, the strips (with their context) start
+    and end on multiples of the reduce factor, so their reduced rows are those of
+    the whole image."""
+    img.load()
+    margin = int(math.ceil(4 * radius)) + 1
+    passes, min_radius = BLUR_ACCURACY_SETTINGS[accuracy]
+    factor = int(radius // min_radius) if passes is not None else 1
+    factor = factor if factor >= 2 else 1
+    def band(y0, y1, top, bottom):
+        top -= top % factor
+        bottom = min(bottom + (-bottom) % factor, img.height)
+        blurred = blur_full(img.crop((0, top, img.width, bottom)), radius, accuracy)
+        return blurred.crop((0, y0 - top, img.width, y1 - top))
+    return strips.stitch(img.size, strips.map_bands(img.height, band, margin))
+
+def blur(img, radius, accuracy=BLUR_ACCURACY, regions=BLUR_REGIONS):
+    """Applies a Gaussian blur to an in-memory image, or only to `regions`."""
+    if not regions:
+        if strips.worth_splitting(img.size):
+            return blur_parallel(img, radius, accuracy)
+        return blur_full(img, radius, accuracy)
+    out = img.copy()
+    margin = int(math.ceil(3 * radius)) # pixels around a box that still weigh in
+    for left, top, right, bottom in regions:
+        box = (int(left * img.width), int(top * img.height),
+               int(right * img.width), int(bottom * img.height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+        # blur the box with some context, so its edges look the same as in a full blur
+        outer = (max(box[0] - margin, 0), max(box[1] - margin, 0),
+                 min(box[2] + margin, img.width), min(box[3] + margin, img.height))
+        blurred = blur_full(img.crop(outer), radius, accuracy)
+        inner = (box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1])
+        out.paste(blurred.crop(inner), box[:2])
+    return out
+
 def blur_image(input_path, output_path, radius):
     """Applies a Gaussian blur to an image."""
     try:
-        with Image.open(input_path) as img:
+        with storage.open_image(input_path) as img:
+            with metrics.phase('decode'):
+                # the input and the blurred copy are both in memory
+                strips.check_budget(img, MEMORY_BUDGET, copies=2)
+                img.load()
             # Apply the blur filter
-            blurred_img = img.filter(ImageFilter.GaussianBlur(radius=radius))
-            blurred_img.save(output_path)
+            with metrics.phase('transform'):
+                blurred_img = blur(img, radius)
+            with metrics.phase('encode'):
+                storage.save_image(blurred_img, output_path)
             
             print(f" Blurred {input_path} to {output_path}")
             return True
@@ -29,77 +134,87 @@ def blur_image(input_path, output_path, radius):
         print(f" Failed to blur {input_path}: {e}")
         return False
 
-def callback(ch, method, properties, body):
-    """This function is called every time a message is received."""
-    print(f"\n Received message...")
-    
+def blur_shared(ref, output_path, radius):
+    """Applies a Gaussian blur to pixels handed over in shared memory."""
+    def blur_and_save(img):
+        with metrics.phase('transform'):
+            blurred_img = blur(img, radius)
+            # RGB is shared as RGBX, which the file formats do not take
+            if blurred_img.mode == 'RGBX':
+                blurred_img = blurred_img.convert('RGB')
+        with metrics.phase('encode'):
+            storage.save_image(blurred_img, output_path)
     try:
-        # 1. Parse the job message (from resize_filter)
-        message = json.loads(body)
-        image_id = message['image_id']
-        
-        # 2. Get the path of the *resized* image
-        resized_path = message['resized_path'] 
-
-        # 3. Define the new output path
-        blurred_path = os.path.join(BLUR_FOLDER, image_id)
+        shm_handoff.with_shared_image(ref, blur_and_save)
+        print(f" Blurred shared memory {ref['shm']} to {output_path}")
+        return True
+    except Exception as e:
+        print(f" Failed to blur shared memory {ref['shm']}: {e}")
+        return False
 
-        # 4. Perform the work (the filter's logic)
-        if blur_image(resized_path, blurred_path, BLUR_RADIUS):
-            
-            # 5. Create the next job message
-            # We copy the original message to preserve keys like 'original_path'
-            next_job_message = message.copy()
-            
-            # --- This is the key to the demo ---
-            # We *overwrite* the 'resized_path' key with our new 'blurred_path'.
-            # This way, the watermark_filter (which reads 'resized_path')
-            # doesn't need to be changed at all.
-            next_job_message['resized_path'] = blurred_path 
-            
-            # 6. Publish to the *next* queue
-            ch.queue_declare(queue=OUT_QUEUE, durable=True)
-            ch.basic_publish(
-                exchange='',
-                routing_key=OUT_QUEUE,
-                body=json.dumps(next_job_message),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            print(f" Sent job to {OUT_QUEUE} for {image_id}")
-            
+def blur_rendition(rendition):
+    """Blurs one rendition (a file or a shared memory segment) into BLUR_FOLDER.
+    Returns the rendition pointing at the blurred file, or None."""
+    blurred_path = storage.path(BLUR_FOLDER, rendition['name'])
+    # unless the same input was already blurred
+    key = cache.key(result_cache.content_key(rendition, rendition.get('path')), blurred_path)
+    if cache.fetch(key, blurred_path):
+        print(f" Cache hit, reused blurred image {rendition['name']}")
+    else:
+        if 'shared' in rendition:
+            ok = blur_shared(rendition['shared'], blurred_path, BLUR_RADIUS)
         else:
-            print(f" [Blurring failed for {image_id}.")
+            ok = blur_image(rendition['path'], blurred_path, BLUR_RADIUS)
+        if not ok:
+            return None
+        cache.store(key, blurred_path)
+    # the segment is freed once this job is acked, downstream reads the file
+    blurred = {k: v for k, v in rendition.items() if k != 'shared'}
+    blurred['path'] = blurred_path
+    blurred['content_key'] = key
+    return blurred
 
-        # 7. Acknowledge the message (tells RabbitMQ the job is done)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        print(f"  Acknowledged message from {IN_QUEUE}")
+def process(message):
+    """Filter logic for one job, runs on a worker. Returns the next job message or None."""
+    image_id = message['image_id']
+    
+    # 1. Get the *resized* image(s): every rendition the resize filter produced
+    # (files, or shared memory segments when it hands over in memory)
+    renditions = resize_filter.job_renditions(message)
 
-    except Exception as e:
-        print(f" Error processing message: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    # 2. Perform the work (the filter's logic), one output per rendition in BLUR_FOLDER
+    blurred = [blur_rendition(r) for r in renditions]
+    if all(blurred):
+        main = next((r for r in blurred if r['name'] == image_id), blurred[0])
+        
+        # 3. Create the next job message
+        # We copy the original message to preserve keys like 'original_path'
+        next_job_message = message.copy()
+        
+        # --- This is the key to the demo ---
+        # We *overwrite* the 'resized_path' key with our new 'blurred_path'.
+        # This way, the watermark_filter (which reads 'resized_path')
+        # doesn't need to be changed at all.
+        next_job_message['resized_path'] = main['path']
+        next_job_message.pop('resized_shm', None)
+        next_job_message['content_key'] = main['content_key']
+        if 'renditions' in message:
+            next_job_message['renditions'] = blurred
+        next_job_message['intermediates'] = storage.with_intermediates(message, [r['path'] for r in blurred])
+        return next_job_message
+
+    print(f" [Blurring failed for {image_id}.")
+    return None
 
 def main():
     """Connects to RabbitMQ and starts consuming messages."""
     print(" Blur Filter starting. Waiting for messages...")
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=RABBITMQ_HOST)
-        )
-        channel = connection.channel()
-
-        # Ensure both queues exist
-        channel.queue_declare(queue=IN_QUEUE, durable=True)
-        channel.queue_declare(queue=OUT_QUEUE, durable=True)
-
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(
-            queue=IN_QUEUE,
-            on_message_callback=callback
-        )
-
-        channel.start_consuming()
+        consumer.run_consumer(IN_QUEUE, OUT_QUEUE, process, host=RABBITMQ_HOST,
+                              prefetch=PREFETCH_COUNT, workers=WORKER_COUNT, worker_type=WORKER_TYPE,
+                              stage='blur', metrics_port=METRICS_PORT)
 
-    except pika.exceptions.AMQPConnectionError:
+    except transport.CONNECTION_ERRORS:
         print(" Could not connect to RabbitMQ. Retrying in 5 seconds...")
         time.sleep(5)
         main() # Retry connection
@@ -0,0 +1,207 @@
+import os
+import functools
+import signal
+import threading
+import time
+import job_store
+import metrics
+import profiling
+import shm_handoff
+import storage
+import tracing
+import transport
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+WORKER_COUNT = os.cpu_count() or 1 # jobs processed at the same time by one filter process
+WORKER_TYPE = 'process' # 'process' uses every core, 'thread' is lighter (Pillow releases the GIL)
+PREFETCH_COUNT = 2 * WORKER_COUNT # unacked messages the broker hands to this consumer
+WORKER_MEMORY_BUDGET = 1024 * 1024 * 1024 # bytes of pixels one job may hold on a worker (see strips.py)
+#-------------------------
+
+class Reroute(Exception):
+    """ Raised by a handler to hand the job, unchanged, to another queue instead of
+    processing it (e.g. to a filter with a larger memory budget)"""
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.queue = queue
+
+def make_pool(worker_type, workers, initializer=None, initargs=()):
+    if worker_type == 'process':
+        return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    if worker_type == 'thread':
+        return ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    raise ValueError(f"Unknown worker type: {worker_type}")
+
+def failure_event(stage, message):
+    """ Completion event of a job that failed at stage: no later stage will see it"""
+    return job_store.completion_event(message.get('image_id'), [], [stage], storage.intermediates(message))
+
+_submitted = {} # stage -> futures of the jobs submitted to its pool, not finished yet
+
+def busy_workers(stage):
+    """ Jobs of stage a worker is running, not the prefetched ones waiting for a
+    worker. A process pool marks a job running as it hands it to its call queue,
+    which holds one job more than the workers"""
+    return sum(1 for future in list(_submitted.get(stage, ())) if future.running())
+
+def interrupt(signum, frame):
+    """ Signal handler that stops the process like CTRL+C"""
+    raise KeyboardInterrupt
+
+def run_consumer(in_queue, out_queue, handler, host=RABBITMQ_HOST,
+                 prefetch=PREFETCH_COUNT, workers=WORKER_COUNT, worker_type=WORKER_TYPE,
+                 stage=None, metrics_port=None, broker=None,
+                 failed_queue=job_store.FINAL_QUEUE, failure=failure_event,
+                 initializer=None, initargs=()):
+    """ Consume in_queue with up to `prefetch` messages in flight and run
+    handler(message) on a thread or process pool.
+
+    in_queue is a queue name or a list of (queue, weight) lanes consumed together.
+    Each lane gets its own share of the prefetch window by weight, so a deep lane
+    cannot take the slots of the others.
+
+    handler returns the next job message (published to out_queue), None when the
+    job failed, or raises Reroute. out_queue may be a list of queues (fan-out),
+    each gets a copy of the next message. A job that failed (None or an exception)
+    is finished: failure(stage, message) is published to failed_queue instead, so
+    its status and files are settled like those of a completed job. Transports
+    are not thread safe, so the publish and ack of a finished job are handed back
+    to the consuming thread with call_soon_threadsafe. The ack follows the broker's confirm of the publish (see
+    transport.RabbitMQTransport). Blocks until the connection is closed.
+
+    broker is a connection from transport.connect(); by default one is opened
+    on the configured backend (RabbitMQ or the local queues).
+
+    initializer(*initargs) runs in every worker before its first job. A setting
+    changed at start-up must be applied there: a worker process that is spawned
+    (not forked) imports the filter modules again, with their defaults.
+
+    Phase timings, queue wait, errors and in-flight jobs are recorded under
+    `stage` and served on metrics_port when one is given. The spans of each job are
+    recorded in its trace (see tracing.py), whose context travels in the message
+    headers. SIGUSR1 or POST /profile?jobs=N on metrics_port profiles the next jobs
+    (see profiling.py)."""
+    lanes = [(in_queue, 1)] if isinstance(in_queue, str) else list(in_queue)
+    stage = stage or lanes[0][0]
+    if threading.current_thread() is threading.main_thread():
+        # a terminated filter (e.g. scaled down by supervisor.py) exits like on CTRL+C,
+        # so its pool workers are shut down instead of being orphaned
+        signal.signal(signal.SIGTERM, interrupt)
+    profiler = profiling.Profiler(stage, threading.get_ident())
+    profiling.install(profiler)
+    if metrics_port is not None:
+        metrics.start_metrics_server(metrics_port)
+    broker = broker or transport.connect(host)
+    # Declare the topology once, not per message
+    for queue_name, _ in lanes:
+        broker.declare(queue_name)
+    out_queues = [out_queue] if isinstance(out_queue, str) else list(out_queue or [])
+    for queue_name in out_queues + ([failed_queue] if failed_queue else []):
+        broker.declare(queue_name)
+    declared = {queue_name for queue_name, _ in lanes} | set(out_queues) | {failed_queue}
+    pool = make_pool(worker_type, workers, initializer, initargs)
+    submitted = _submitted.setdefault(stage, set())
+
+    def trace_job(trace, message, received_at, record):
+        """ Record the stage span of a job, with its queue wait and phases under it.
+        Returns the headers passing the context on to the next stage"""
+        trace_id, parent_id, span_id = trace
+        image_id = message.get('image_id')
+        enqueued_at = message.get('enqueued_at') or received_at
+        spans = [tracing.span(trace_id, span_id, parent_id, image_id, stage, 'stage',
+                              enqueued_at, time.time() - enqueued_at),
+                 tracing.span(trace_id, tracing.new_id(), span_id, image_id, stage, 'queue_wait',
+                              enqueued_at, max(received_at - enqueued_at, 0.0))]
+        for name, start, elapsed in record.get('spans', ()):
+            spans.append(tracing.span(trace_id, tracing.new_id(), span_id, image_id, stage, name,
+                                      start, elapsed))
+        tracing.record(spans)
+        return tracing.headers(trace_id, span_id)
+
+    def fail(delivery, message, headers):
+        """ Settle a failed job: its failure event replaces the next message"""
+        if failed_queue is None:
+            broker.nack(delivery)
+            shm_handoff.release(message)
+            return
+        broker.forward(failed_queue, failure(stage, message), delivery, headers,
+                       functools.partial(shm_handoff.release, message))
+        print(f"Job {message.get('image_id')} failed at {stage}, published to {failed_queue}")
+
+    def finish(delivery, message, trace, received_at, started, profiled, future):
+        """Runs on the consuming thread once the handler is done."""
+        metrics.IN_FLIGHT.dec(stage=stage)
+        submitted.discard(future)
+        if profiled and profiler.job_done(future):
+            # after this job's publish, so the session covers it
+            broker.call_soon_threadsafe(profiler.dump)
+        try:
+            next_message, record = future.result()
+        except BrokenProcessPool:
+            # A worker process died; stop so unacked jobs are redelivered
+            raise
+        except Reroute as e:
+            if e.queue not in declared:
+                broker.declare(e.queue)
+                declared.add(e.queue)
+            headers = trace_job(trace, message, received_at, {})
+            message['enqueued_at'] = time.time()
+            broker.forward(e.queue, message, delivery, headers)
+            metrics.JOBS.inc(stage=stage, outcome='rerouted')
+            print(f"Rerouted job {message.get('image_id')} to {e.queue}")
+            return
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            trace_job(trace, message, received_at, {})
+            metrics.JOBS.inc(stage=stage, outcome='error')
+            fail(delivery, message, tracing.headers(trace[0], trace[2]))
+            return
+        if next_message is None:
+            fail(delivery, message, tracing.headers(trace[0], trace[2]))
+        elif out_queues:
+            publish_start = time.perf_counter()
+            # lets the next stage measure how long the job waited in its queue
+            next_message['enqueued_at'] = time.time()
+            # acked once the broker confirms the publish, without waiting for it here.
+            # Pixels handed over in shared memory are freed then: a job requeued by a
+            # nack of the broker still finds them
+            broker.forward_many(out_queues, next_message, [delivery], tracing.headers(trace[0], trace[2]),
+                                functools.partial(shm_handoff.release, message))
+            record['phases']['publish'] = time.perf_counter() - publish_start
+            record['spans'].append(('publish', next_message['enqueued_at'], record['phases']['publish']))
+            print(f"Published job to {', '.join(out_queues)} for {next_message.get('image_id')}")
+        else:
+            broker.ack(delivery, functools.partial(shm_handoff.release, message))
+        trace_job(trace, message, received_at, record)
+        metrics.observe_job(stage, record, time.perf_counter() - started)
+
+    def on_message(message, delivery, headers):
+        metrics.observe_queue_wait(stage, message)
+        metrics.IN_FLIGHT.inc(stage=stage)
+        # (trace id, span of the previous stage, span of this stage)
+        trace = tracing.parse(headers) + (tracing.new_id(),)
+        received_at = time.time()
+        started = time.perf_counter()
+        profiled = profiler.take()
+        if profiled:
+            future = pool.submit(profiling.run_profiled, handler, message, message.get('image_id'))
+        else:
+            future = pool.submit(metrics.run_measured, handler, message)
+        submitted.add(future)
+        future.add_done_callback(lambda f: broker.call_soon_threadsafe(
+            functools.partial(finish, delivery, message, trace, received_at, started, profiled, f)))
+
+    total_weight = sum(weight for _, weight in lanes)
+    for queue_name, weight in lanes:
+        broker.consume(queue_name, on_message, max(1, round(prefetch * weight / total_weight)))
+    print(f"Waiting for messages in {', '.join(q for q, _ in lanes)} ({workers} {worker_type} "
+          f"workers, prefetch {prefetch}). To exit press CTRL+C")
+    try:
+        broker.run()
+    finally:
+        # Unacked jobs go back to the queue when the connection closes
+        pool.shutdown(wait=False, cancel_futures=True)
+        broker.close()
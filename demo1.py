@@ -1,15 +1,16 @@
-import subprocess
 import requests
 import time
 import os
 import pika
 import sys
+import bench
  
 # Loading configuration
 RABBITMQ_HOST = 'localhost'
 UPLOAD_URL = 'http://localhost:5001/upload'
 TEST_IMAGE_PATH = 'test_images/1.jpg' # <-- Make sure this file exists
 UPLOAD_IMG_NO = 5
+UPLOAD_RETRIES = 5 # times an upload refused with 429 is retried, after its Retry-After
 
 
 PYTHON_CMD = sys.executable 
@@ -45,82 +46,74 @@ def check_dependencies():
            
     return True
 
-def get_queue_length(queue_name):
-    """Checks RabbitMQ and returns the number of messages in a queue."""
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-    channel = connection.channel()
-    # passive=True checks the queue without modifying it
-    queue_state = channel.queue_declare(queue=queue_name, durable=True, passive=True) 
-    connection.close()
-    return queue_state.method.message_count
+def upload_one(f, filename):
+    """Uploads one image, waiting out the pump's 429s. Returns the response."""
+    for _ in range(UPLOAD_RETRIES):
+        f.seek(0) # <-- Rewind file for the next upload
+        response = requests.post(UPLOAD_URL, files={'file': (filename, f, 'image/jpg')})
+        if response.status_code != 429:
+            return response
+        retry_after = int(response.headers.get('Retry-After', 1))
+        print(f"     Pipeline busy, retrying in {retry_after}s...")
+        time.sleep(retry_after)
+    return response
 
 def upload_images():
-    """Uploads the test image N times."""
+    """Uploads the test image N times. Returns the job ids, or None on failure."""
     print(f"  Uploading {UPLOAD_IMG_NO} images...")
-    
+    job_ids = []
     try:
         with open(TEST_IMAGE_PATH, 'rb') as f:
             filename = os.path.basename(TEST_IMAGE_PATH)
-            files = {'file': (filename, f, 'image/jpg')} 
-            
-            
             for i in range(UPLOAD_IMG_NO):
                 try:
-                    f.seek(0) # <-- Rewind file for the next upload
-                    requests.post(UPLOAD_URL, files=files)
+                    response = upload_one(f, filename)
+                    if response.status_code != 200:
+                        print(f" Upload failed with {response.status_code}: {response.text[:200]}")
+                        return None
+                    job_ids.append(response.json()['job']['image_id'])
                     print(f"     Uploaded image {i+1}/{UPLOAD_IMG_NO}")
                 except requests.exceptions.ConnectionError:
                     print(" Upload failed. Is app.py (the Pump) running?")
-                    return False
+                    return None
     except FileNotFoundError:
         print(f" ERROR: Test image not found at {TEST_IMAGE_PATH}")
-        return False
+        return None
     
     print("  Uploads complete.")
-    return True
-
-def wait_for_queues_to_drain(timeout_sec=60):
-    """Waits until both processing queues are empty."""
-    start = time.time()
-    while time.time() - start < timeout_sec:
-        try:
-            uploads = get_queue_length('upload_queue')
-            watermarks = get_queue_length('watermark_queue')
-            print(f"  ... processing ... (Uploads: {uploads}, Watermarks: {watermarks})")
-            if uploads == 0 and watermarks == 0:
-                print(" Queues are empty. Processing complete.")
-                return True
-            time.sleep(1)
-        except Exception as e:
-            print(f"  ... waiting for queues to appear ...")
-            time.sleep(1)
-    
-    print("  ERROR: Timeout waiting for queues to drain.")
-    return False
+    return job_ids
 
 def run_test(num_resize_filters):
     """Runs a complete test with a given number of filters."""
     print(f"\n--- Starting test with {num_resize_filters} Resize Filter(s) ---")
     #Start filters
     filters = []
+    # One worker per filter and no result cache, so that N filters really means
+    # N images processed at a time (the same image is uploaded every time)
     for _ in range(num_resize_filters):
-        filters.append(subprocess.Popen([PYTHON_CMD, "resize_filter.py"]))
+        filters.append(bench.start_filter("resize_filter", workers=1))
     
     # one watermark filter for this test
-    filters.append(subprocess.Popen([PYTHON_CMD, "water_filter.py"]))
+    filters.append(bench.start_filter("water_filter", workers=1))
     
     print(f" Started {len(filters)} filter processes. Waiting 3s for them to boot...")
     time.sleep(3)
 
     # Upload images and calculate time taken
     start_time = time.time()
-    if not upload_images():
+    job_ids = upload_images()
+    if job_ids is None:
         # Clean up filters if upload failed
         for f in filters:
             f.terminate()
         return -1  # Upload failed
     
-    wait_for_queues_to_drain()
+    # Done when every final image exists, not when the queues look empty
+    # (jobs can still be unacked inside a filter). See bench.py for a full benchmark.
+    if bench.wait_for_results(job_ids):
+        print(" All final images written. Processing complete.")
+    else:
+        print("  ERROR: Timeout waiting for the final images.")
     end_time = time.time()
     duration = end_time - start_time
     print(f"  Test completed in {duration:.2f} seconds.")
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+
+import consumer
+import ingest
+import transport
+import result_cache
+import metrics
+import storage
+import resize_filter
+import blur_filter
+import water_filter
+import strips
+import job_store
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+IN_LANES = ingest.LANE_WEIGHTS #Queues to listen: small and large uploads, weighted (see ingest.py)
+OUTPUT_FOLDER = water_filter.WATERMARK_FOLDER # only the final image is written
+# Stages to chain on the in-memory image, in order.
+# Add 'blur' between them to get the same result as resize -> blur -> watermark
+FUSED_STAGES = ['resize', 'watermark']
+# Concurrency of this filter process (see consumer.py)
+WORKER_COUNT = consumer.WORKER_COUNT
+WORKER_TYPE = consumer.WORKER_TYPE
+PREFETCH_COUNT = consumer.PREFETCH_COUNT
+METRICS_PORT = 9104 # http://localhost:9104/metrics
+MEMORY_BUDGET = consumer.WORKER_MEMORY_BUDGET # see resize_filter.py for oversized inputs
+# ensure folder exists
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+#-------------------------
+# Each stage reuses the in-memory logic of the standalone filter,
+# so the fused mode and the separately deployed filters give the same output.
+STAGES = {
+    'resize': lambda img: resize_filter.resize(img, resize_filter.RESIZE_WIDTH),
+    'blur': lambda img: blur_filter.blur(img, blur_filter.BLUR_RADIUS),
+    'watermark': lambda img: water_filter.watermark(img, water_filter.WATERMARK_TEXT),
+}
+# Same keys as the standalone filters, so both modes share cached results
+STAGE_CACHES = {
+    'resize': resize_filter.cache,
+    'blur': blur_filter.cache,
+    'watermark': water_filter.cache,
+}
+
+def process_image(in_path,out_path,stages):
+    """ Decode the image once, run all stages on it in memory and save only the result"""
+    try:
+        with storage.open_image(in_path) as img:
+            with metrics.phase('decode'):
+                if stages and stages[0] == 'resize':
+                    # JPEG draft, or strip by strip for large uncompressed files
+                    img = resize_filter.decode_within_budget(img, in_path, resize_filter.RESIZE_WIDTH,
+                                                             MEMORY_BUDGET)
+                else:
+                    strips.check_budget(img, MEMORY_BUDGET, copies=2)
+                    img.load()
+            with metrics.phase('transform'):
+                for stage in stages:
+                    img = STAGES[stage](img)
+            with metrics.phase('encode'):
+                storage.save_image(img, out_path)
+            print(f"Processed {in_path} ({' -> '.join(stages)}) saved to {out_path}")
+            return True
+    except consumer.Reroute:
+        raise
+    except Exception as e:
+        print(f"Error processing image {in_path}: {e}")
+        return False
+
+def process(message):
+    """ Run all fused stages for one job on a worker. This is the sink: it publishes
+    the completion event of the job"""
+    image_id = message['image_id']
+    image_path = message['original_path']
+    print(f"Processing image_id: {image_id}, image_path: {image_path}")
+    # 1. Define the final output path
+    output_path = storage.path(OUTPUT_FOLDER,image_id)
+    # 2. Chain the stage cache keys; only the final result is cached here
+    key = result_cache.content_key(message, image_path)
+    for stage in FUSED_STAGES:
+        key = STAGE_CACHES[stage].key(key, output_path)
+    final_cache = STAGE_CACHES[FUSED_STAGES[-1]]
+    # 3. Perform the work of all fused filters, unless the same input was already processed
+    if final_cache.fetch(key, output_path):
+        print(f"Cache hit, reused final image for {image_id}")
+    elif process_image(image_path,output_path,FUSED_STAGES):
+        final_cache.store(key, output_path)
+        print(f"Fused pipeline finished for {image_id}")
+    else:
+        print(f"Fused pipeline failed for {image_id}")
+        return job_store.completion_event(image_id, [], [image_id], storage.intermediates(message))
+    result = {'name': image_id, 'width': resize_filter.RESIZE_WIDTH, 'path': output_path}
+    return job_store.completion_event(image_id, [result], [], storage.intermediates(message))
+
+def main():
+    """ Main function to setup RabbitMQ connection and start consuming messages """
+    print(f"Fused Filter starting ({' -> '.join(FUSED_STAGES)}), Waiting for messages...")
+    try:
+        consumer.run_consumer(IN_LANES, job_store.FINAL_QUEUE, process, host=RABBITMQ_HOST,
+                              prefetch=PREFETCH_COUNT, workers=WORKER_COUNT, worker_type=WORKER_TYPE,
+                              stage='fused', metrics_port=METRICS_PORT)
+    except transport.CONNECTION_ERRORS:
+        print("Error: Unable to connect to RabbitMQ server. Is it running? Retrying in 5 seconds...")
+        time.sleep(5)
+        main()
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping filter...")
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
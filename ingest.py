@@ -0,0 +1,35 @@
+from PIL import Image
+
+#------configuration------
+# Uploads are routed by cost into lanes, so a backfill of huge scans does not queue
+# up in front of phone photos. SMALL_LANE keeps the original queue name.
+SMALL_LANE = 'upload_queue'
+LARGE_LANE = 'upload_bulk_queue'
+LARGE_JOB_PIXELS = 16000000 # cost (decoded pixels) from which a job takes the large lane
+# Share of a first-stage filter's prefetch window per lane. Small jobs always find
+# free slots, whatever the depth of the large lane
+LANE_WEIGHTS = [(SMALL_LANE, 3), (LARGE_LANE, 1)]
+LANES = [lane for lane, _ in LANE_WEIGHTS]
+#-------------------------
+
+def probe(path):
+    """ Format, size and mode from the image header (no pixel is decoded).
+    None when Pillow cannot identify the file"""
+    try:
+        with Image.open(path) as img:
+            return {'format': img.format, 'width': img.width, 'height': img.height, 'mode': img.mode}
+    except Exception:
+        return None
+
+def job_cost(info):
+    """ Cost estimate of a job: the pixels the first stage decodes, None if unknown"""
+    if info is None:
+        return None
+    return info['width'] * info['height']
+
+def lane_for(cost):
+    """ Queue for a job of this cost. Unknown costs take the small lane: a file
+    Pillow cannot read fails fast in the filter"""
+    if cost is not None and cost >= LARGE_JOB_PIXELS:
+        return LARGE_LANE
+    return SMALL_LANE
@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+
+import storage
+import transport
+
+#------configuration------
+JOB_DB = 'jobs.db' # SQLite file of the pump, one row per job
+FINAL_QUEUE = 'final_queue' # completion events published by the last stage
+EVENTS_PREFETCH = 64 # completion events the pump takes at once
+#-------------------------
+
+# Final states: a job in one of them will not change again
+FINAL_STATUSES = ('done', 'failed')
+
+def completion_event(image_id, results, failed, intermediates=()):
+    """ Message published by the last stage once a job is finished. results are
+    the written files: [{'name', 'width', 'path'}], failed the names that were not,
+    intermediates the files written on the way (see storage.py)"""
+    return {
+        'image_id': image_id,
+        'status': 'failed' if failed or not results else 'done',
+        'results': results,
+        'failed': failed,
+        'intermediates': list(intermediates),
+        'completed_at': time.time(),
+    }
+
+class JobStore:
+    """ Status of the jobs by id, in SQLite (the id is the primary key, so a lookup
+    is an index search whatever the number of jobs). Thread safe.
+
+    Waiters (long-polling requests) are woken up when a job of this process
+    reaches a final state"""
+
+    def __init__(self, path=JOB_DB):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            lane TEXT,
+            submitted_at REAL,
+            completed_at REAL,
+            results TEXT,
+            failed TEXT)""")
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def submitted(self, jobs):
+        """ Record new jobs: [(lane, job message)]"""
+        with self._lock:
+            # one transaction (one disk sync) for a whole batch
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT OR IGNORE INTO jobs (id, status, lane, submitted_at) VALUES (?, ?, ?, ?)',
+                [(m['image_id'], 'queued', lane, m.get('enqueued_at')) for lane, m in jobs])
+            self._db.execute('COMMIT')
+
+    def completed(self, event):
+        """ Record a completion event from FINAL_QUEUE"""
+        with self._lock:
+            # a job submitted through another pump has no row yet
+            self._db.execute(
+                """INSERT INTO jobs (id, status, completed_at, results, failed) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET status = excluded.status,
+                   completed_at = excluded.completed_at, results = excluded.results,
+                   failed = excluded.failed""",
+                (event['image_id'], event['status'], event.get('completed_at'),
+                 json.dumps(event.get('results', [])), json.dumps(event.get('failed', []))))
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        """ The job as a dict, None if unknown"""
+        with self._lock:
+            return self._get(job_id)
+
+    def _get(self, job_id):
+        row = self._db.execute(
+            'SELECT id, status, lane, submitted_at, completed_at, results, failed FROM jobs WHERE id = ?',
+            (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'status', 'lane', 'submitted_at', 'completed_at'), row[:5]))
+        job['results'] = json.loads(row[5]) if row[5] else []
+        job['failed'] = json.loads(row[6]) if row[6] else []
+        return job
+
+    def wait(self, job_id, timeout):
+        """ The job once it is in a final state, or as it is after timeout seconds"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                job = self._get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job['status'] in FINAL_STATUSES or remaining <= 0:
+                    return job
+                self._changed.wait(remaining)
+
+def consume_events(store, host=transport.RABBITMQ_HOST, reaper=None):
+    """ Feed the store from FINAL_QUEUE, forever (run it on a daemon thread).
+    The intermediate files of a recorded job are handed to the reaper"""
+    while True:
+        try:
+            broker = transport.connect(host)
+            try:
+                broker.declare(FINAL_QUEUE)
+                def on_event(event, delivery, headers):
+                    try:
+                        store.completed(event)
+                    except (KeyError, TypeError) as e:
+                        # not a completion event, a redelivery would fail the same way
+                        print(f"Job events: dropped a malformed event ({e!r})")
+                        broker.nack(delivery)
+                        return
+                    if reaper is not None:
+                        reaper.schedule(storage.to_reap(event))
+                    broker.ack(delivery)
+                broker.consume(FINAL_QUEUE, on_event, EVENTS_PREFETCH)
+                broker.run()
+            finally:
+                broker.close()
+        except transport.CONNECTION_ERRORS:
+            print("Job events: unable to connect to the message broker, retrying in 5 seconds...")
+            time.sleep(5)
+        except Exception as e:
+            # e.g. SQLite: the unacked events are redelivered on the next connection
+            print(f"Job events: {e!r}, restarting in 5 seconds...")
+            time.sleep(5)
+
+def start_event_consumer(store, host=transport.RABBITMQ_HOST, reaper=None):
+    thread = threading.Thread(target=consume_events, args=(store, host, reaper), daemon=True)
+    thread.start()
+    return thread
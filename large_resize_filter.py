@@ -0,0 +1,40 @@
+import sys
+import time
+
+import consumer
+import transport
+import resize_filter
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+IN_QUEUE = resize_filter.OVERSIZE_QUEUE # filled by resize filters with OVERSIZE_ACTION = 'reroute'
+OUT_QUEUE = resize_filter.OUT_QUEUE
+# One large image at a time, with the memory the regular filter splits between its workers
+WORKER_COUNT = 1
+MEMORY_BUDGET = consumer.WORKER_MEMORY_BUDGET * consumer.WORKER_COUNT
+METRICS_PORT = 9105 # http://localhost:9105/metrics
+#-------------------------
+
+def configure():
+    """ Resize filter settings of this process, applied again in each worker """
+    resize_filter.MEMORY_BUDGET = MEMORY_BUDGET
+    resize_filter.OVERSIZE_ACTION = 'reject' # nowhere left to reroute to
+
+def main():
+    """ Resize filter for the rerouted oversized uploads """
+    configure()
+    print(f"Large Resize Filter starting ({MEMORY_BUDGET >> 20} MB budget), Waiting for messages...")
+    try:
+        consumer.run_consumer(IN_QUEUE, OUT_QUEUE, resize_filter.process, host=RABBITMQ_HOST,
+                              prefetch=WORKER_COUNT, workers=WORKER_COUNT, worker_type='process',
+                              stage='resize_large', metrics_port=METRICS_PORT, initializer=configure)
+    except transport.CONNECTION_ERRORS:
+        print("Error: Unable to connect to RabbitMQ server. Is it running? Retrying in 5 seconds...")
+        time.sleep(5)
+        main()
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping filter...")
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import sys
+import transport
+
+# Run this instead of RabbitMQ to use the in-process / multiprocessing queue
+# backend on a single host. Start the pump and the filters with
+# PIPELINE_TRANSPORT=local so they connect to it.
+
+def main():
+    try:
+        transport.serve_local_broker()
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping local broker...")
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
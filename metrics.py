@@ -0,0 +1,229 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+#------configuration------
+# Latency buckets in seconds, shared by every histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#-------------------------
+
+class Metric:
+    """ Base for a named metric with label values, safe to update from any thread"""
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {value}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observed = self._values.get(key, ([0] * len(BUCKETS), 0.0, 0))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, observed + 1)
+
+    def _render_value(self, key, value):
+        counts, total, observed = value
+        lines = [f"{self.name}_bucket{self._label_text(key, [('le', bound)])} {count}"
+                 for bound, count in zip(BUCKETS, counts)]
+        lines.append(f"{self.name}_bucket{self._label_text(key, [('le', '+Inf')])} {observed}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {observed}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {total}")
+        return lines
+
+REGISTRY = []
+
+#------Pipeline metrics -----#
+PHASE_SECONDS = Histogram('pipeline_phase_seconds',
+                          'Time spent per job in each phase (decode, transform, encode, publish)',
+                          ['stage', 'phase'])
+QUEUE_WAIT_SECONDS = Histogram('pipeline_queue_wait_seconds',
+                               'Time a job spent in the input queue before this stage received it',
+                               ['stage'])
+JOB_SECONDS = Histogram('pipeline_job_seconds', 'Total handling time of a job in a stage', ['stage'])
+JOBS = Counter('pipeline_jobs_total', 'Jobs handled by a stage, by outcome', ['stage', 'outcome'])
+ERRORS = Counter('pipeline_errors_total', 'Errors raised in a phase', ['stage', 'phase'])
+IN_FLIGHT = Gauge('pipeline_in_flight', 'Jobs received and not yet acknowledged', ['stage'])
+PROCESSES = Gauge('pipeline_processes', 'Filter processes run by the supervisor', ['stage'])
+QUEUE_DEPTH = Gauge('pipeline_queue_depth', 'Messages waiting in a stage\'s input queues', ['stage'])
+UTILIZATION = Gauge('pipeline_utilization', 'Busy share of a stage\'s workers', ['stage'])
+
+def render():
+    """ All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+#------Per-job phase timing -----#
+# Phases are timed inside the worker (thread or process) that runs the job and
+# sent back with the result, so process-pool workers need no shared state.
+_job = threading.local()
+
+@contextmanager
+def phase(name):
+    """ Time a phase of the current job; errors raised inside are counted for it"""
+    started_at = time.time() # start of the trace span (see tracing.py)
+    start = time.perf_counter()
+    record = getattr(_job, 'record', None)
+    try:
+        yield
+    except Exception:
+        if record is not None:
+            record['errors'].append(name)
+        raise
+    finally:
+        if record is not None:
+            elapsed = time.perf_counter() - start
+            record['phases'][name] = record['phases'].get(name, 0.0) + elapsed
+            record['spans'].append((name, started_at, elapsed))
+
+@contextmanager
+def timed(stage, name):
+    """ Time a phase outside of a worker job (e.g. in the pump) straight into the metrics"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage, phase=name)
+        raise
+    finally:
+        PHASE_SECONDS.observe(time.perf_counter() - start, stage=stage, phase=name)
+
+def run_measured(handler, message):
+    """ Runs handler(message) in a worker and returns (result, phase record)"""
+    _job.record = {'phases': {}, 'errors': [], 'spans': []}
+    try:
+        return handler(message), _job.record
+    finally:
+        _job.record = None
+
+def observe_job(stage, record, seconds):
+    """ Record a finished job's phase timings in this process' metrics"""
+    for name, elapsed in record['phases'].items():
+        PHASE_SECONDS.observe(elapsed, stage=stage, phase=name)
+    for name in record['errors']:
+        ERRORS.inc(stage=stage, phase=name)
+    JOB_SECONDS.observe(seconds, stage=stage)
+    JOBS.inc(stage=stage, outcome='failed' if record['errors'] else 'ok')
+
+def observe_queue_wait(stage, message):
+    """ Queue wait from the enqueue timestamp the producer put in the message"""
+    enqueued_at = message.get('enqueued_at')
+    if enqueued_at is not None:
+        QUEUE_WAIT_SECONDS.observe(max(time.time() - enqueued_at, 0.0), stage=stage)
+
+#------HTTP endpoint -----#
+# POST <path>?<query> on the metrics port calls CONTROLS[path](query dict), which
+# returns the text of the reply (e.g. /profile, see profiling.py). /metrics is served
+# to everyone, the controls only to clients on this host: they change the process
+CONTROLS = {}
+CONTROL_CLIENTS = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        self._reply(render(), 'text/plain; version=0.0.4')
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        control = CONTROLS.get(path)
+        if control is None:
+            self.send_error(404)
+            return
+        if self.client_address[0] not in CONTROL_CLIENTS:
+            self.send_error(403, "Controls are only accepted from this host")
+            return
+        try:
+            reply = control(dict(parse_qsl(query)))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self._reply(reply + '\n', 'text/plain')
+
+    def _reply(self, text, content_type):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # keep scrapes out of the filter's output
+
+_server = None
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """ Serve /metrics from a daemon thread, once per process. If the port is taken
+    (e.g. a second instance of the same filter on this host) a free port is used instead"""
+    global _server
+    if _server is not None:
+        return _server
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError:
+        server = ThreadingHTTPServer((host, 0), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available on http://localhost:{server.server_port}/metrics")
+    _server = server
+    return server
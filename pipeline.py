@@ -0,0 +1,400 @@
+import argparse
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+import consumer
+import ingest
+import job_store
+import metrics
+import resize_filter
+import shm_handoff
+import storage
+import tracing
+import transport
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+PIPELINE_SPEC = 'pipeline.json' # stages, parameters and edges (see readme.md)
+JOIN_PREFETCH = 100 # branch messages an aggregator takes at once (they are acked once stored)
+JOIN_TIMEOUT = 300 # seconds after which a job missing a branch is completed as failed
+JOIN_DB = 'joins.db' # SQLite file of the aggregators: branches received, jobs completed
+JOIN_FIRED_RETENTION = 24 * 3600 # seconds a completed job is remembered, to drop its late branches
+#-------------------------
+
+# A spec is a JSON object:
+#   {"stages": {"<name>": {"filter": "<module>", "params": {...}, "next": [...],
+#                          "cheap": true, "workers": 2},
+#               "<name>": {"aggregate": true, "next": [...]}}}
+# "filter" is a module with a process(message) function (the filter scripts),
+# "params" overrides its configuration constants, "next" lists the stages fed with
+# its output: more than one is a fan-out, the branches run concurrently. A stage
+# fed by several branches must be an aggregator: it fires once all of them are done.
+# The stage nobody feeds consumes the upload lanes; the stage that feeds nobody
+# publishes the completion event of the job (see job_store.py).
+
+class SpecError(ValueError):
+    """ The pipeline spec is not a valid DAG"""
+
+def load_spec(path=PIPELINE_SPEC):
+    with open(path) as f:
+        spec = json.load(f)
+    validate(spec)
+    return spec
+
+def predecessors(spec):
+    stages = spec['stages']
+    before = {name: [] for name in stages}
+    for name, stage in stages.items():
+        for successor in stage.get('next', []):
+            if successor not in stages:
+                raise SpecError(f"Stage {name} feeds unknown stage {successor}")
+            before[successor].append(name)
+    return before
+
+def topological_order(spec):
+    before = predecessors(spec)
+    order, ready = [], [name for name, preds in before.items() if not preds]
+    left = {name: len(preds) for name, preds in before.items()}
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for successor in spec['stages'][name].get('next', []):
+            left[successor] -= 1
+            if left[successor] == 0:
+                ready.append(successor)
+    if len(order) != len(spec['stages']):
+        raise SpecError("The stages form a cycle")
+    return order
+
+def validate(spec):
+    stages = spec.get('stages') or {}
+    if not stages:
+        raise SpecError("The spec has no stages")
+    before = predecessors(spec)
+    topological_order(spec)
+    sources = [name for name, preds in before.items() if not preds]
+    sinks = [name for name, stage in stages.items() if not stage.get('next')]
+    if len(sources) != 1:
+        raise SpecError(f"Exactly one stage must consume the uploads, found {sources}")
+    if len(sinks) != 1:
+        raise SpecError(f"Exactly one stage must finish the job (join the branches with an "
+                        f"aggregator), found {sinks}")
+    for name, stage in stages.items():
+        if stage.get('aggregate'):
+            if not before[name]:
+                raise SpecError(f"Aggregator {name} has no branches")
+        elif 'filter' not in stage:
+            raise SpecError(f"Stage {name} has no filter")
+        elif len(before[name]) > 1:
+            raise SpecError(f"Stage {name} is fed by {before[name]}: make it an aggregator")
+
+def queue_for(name):
+    return f"{name}_queue"
+
+def plan(spec):
+    """ Split the stages into process groups. A stage joins the group of the stage
+    before it when both are marked cheap, the edge between them is their only one
+    and they run different filters: the hop through the broker is saved.
+    Returns [(group stage names, in queues, out queues)]"""
+    stages = spec['stages']
+    before = predecessors(spec)
+    groups, group_of = [], {}
+    for name in topological_order(spec):
+        stage = stages[name]
+        preds = before[name]
+        if len(preds) == 1 and not stage.get('aggregate'):
+            previous = stages[preds[0]]
+            group = group_of[preds[0]]
+            if (stage.get('cheap') and previous.get('cheap') and len(previous.get('next', [])) == 1
+                    and group[-1] == preds[0]
+                    and stage['filter'] not in [stages[s].get('filter') for s in group]):
+                group.append(name)
+                group_of[name] = group
+                continue
+        group = [name]
+        groups.append(group)
+        group_of[name] = group
+    wiring = []
+    for group in groups:
+        head, last = group[0], group[-1]
+        in_queues = ingest.LANE_WEIGHTS if not before[head] else [(queue_for(head), 1)]
+        successors = stages[last].get('next', [])
+        out_queues = [queue_for(s) for s in successors] or [job_store.FINAL_QUEUE]
+        wiring.append((group, in_queues, out_queues))
+    return wiring
+
+#------Stages -----#
+_modules = {} # stage name -> its configured filter module, in the group process and each worker
+
+def configure(spec, group):
+    """ Import the filters of a group and apply the spec parameters to them"""
+    for name in group:
+        stage = spec['stages'][name]
+        if stage.get('aggregate'):
+            continue
+        module = importlib.import_module(stage['filter'])
+        for key, value in stage.get('params', {}).items():
+            if not hasattr(module, key):
+                raise SpecError(f"{stage['filter']} has no parameter {key}")
+            setattr(module, key, value)
+            if key.endswith('_FOLDER'):
+                os.makedirs(value, exist_ok=True)
+        if hasattr(module, 'make_cache'):
+            module.cache = module.make_cache() # keyed by the new parameters
+        if len(stage.get('next', [])) > 1 and getattr(module, 'HANDOFF_MODE', 'file') == 'shm':
+            # every branch would free the same segments
+            raise SpecError(f"Stage {name} fans out, it cannot hand over in shared memory")
+        _modules[name] = module
+
+def completion(message):
+    """ Completion event for the output of a sink stage that is not one already"""
+    if 'status' in message:
+        return message
+    results = [{'name': r['name'], 'width': r.get('width'), 'path': r['path']}
+               for r in resize_filter.job_renditions(message) if 'path' in r]
+    return job_store.completion_event(message['image_id'], results, [], storage.intermediates(message))
+
+def run_group(group, sink, message):
+    """ Handler of a process group: the stages run one after the other on the same
+    worker, the message of each is handed to the next without the broker"""
+    for i, name in enumerate(group):
+        result = _modules[name].process(message)
+        if i:
+            shm_handoff.release(message) # pixels of a colocated hop
+        if result is None:
+            return None
+        message = result
+    if sink:
+        message = completion(message)
+    message['from_stage'] = group[-1] # tells an aggregator which branch this is
+    return message
+
+def failure_target(spec, group):
+    """ Where a job failing in group is reported: (queue, branch). In a branch, the
+    aggregator joining it, which then completes the job without waiting for
+    JOIN_TIMEOUT; anywhere else, final_queue"""
+    stages = spec['stages']
+    name = group[-1]
+    while len(stages[name].get('next', [])) == 1:
+        successor = stages[name]['next'][0]
+        if stages[successor].get('aggregate'):
+            return queue_for(successor), name
+        name = successor
+    return job_store.FINAL_QUEUE, None
+
+def branch_failure(branch, stage, message):
+    """ Failure event of a job standing in for the output of its branch"""
+    event = consumer.failure_event(stage, message)
+    event['from_stage'] = branch
+    return event
+
+def aggregate(image_id, branches):
+    """ Completion event of a job from the outputs of its branches: {stage: message}"""
+    results, failed, intermediates = [], [], []
+    for branch, message in sorted(branches.items()):
+        if message is None:
+            failed.append(branch)
+            continue
+        event = completion(message)
+        results.extend(dict(r, branch=branch) for r in event['results'])
+        failed.extend(event['failed'])
+        # the branches share the files written before the fan-out
+        intermediates.extend(p for p in event['intermediates'] if p not in intermediates)
+    return job_store.completion_event(image_id, results, failed, intermediates)
+
+class JoinStore:
+    """ Branch messages an aggregator received, by job, in SQLite, and the jobs it
+    completed recently. Used from the connection thread only"""
+
+    def __init__(self, stage, path=JOIN_DB):
+        self.stage = stage
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute("""CREATE TABLE IF NOT EXISTS branches (
+            stage TEXT NOT NULL,
+            image_id TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            message TEXT NOT NULL,
+            headers TEXT NOT NULL,
+            arrived_at REAL NOT NULL,
+            PRIMARY KEY (stage, image_id, branch))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS fired (
+            stage TEXT NOT NULL,
+            image_id TEXT NOT NULL,
+            fired_at REAL NOT NULL,
+            PRIMARY KEY (stage, image_id))""")
+
+    def add(self, image_id, branch, message, headers):
+        """ Store a branch message, a redelivered copy replaces the first one"""
+        self._db.execute('INSERT OR REPLACE INTO branches VALUES (?, ?, ?, ?, ?, ?)',
+                         (self.stage, image_id, branch, json.dumps(message), json.dumps(headers),
+                          time.time()))
+
+    def branches(self, image_id):
+        """ {branch: (message, headers)} of a job"""
+        rows = self._db.execute('SELECT branch, message, headers FROM branches WHERE stage = ? AND image_id = ?',
+                                (self.stage, image_id))
+        return {branch: (json.loads(message), json.loads(headers)) for branch, message, headers in rows}
+
+    def expired(self, timeout):
+        """ Jobs whose first branch arrived more than timeout seconds ago"""
+        rows = self._db.execute(
+            'SELECT image_id FROM branches WHERE stage = ? GROUP BY image_id HAVING MIN(arrived_at) < ?',
+            (self.stage, time.time() - timeout))
+        return [image_id for image_id, in rows]
+
+    def has_fired(self, image_id):
+        return self._db.execute('SELECT 1 FROM fired WHERE stage = ? AND image_id = ?',
+                                (self.stage, image_id)).fetchone() is not None
+
+    def fired(self, image_id):
+        """ Forget the branches of a completed job, remember that it completed"""
+        self._db.execute('BEGIN')
+        self._db.execute('DELETE FROM branches WHERE stage = ? AND image_id = ?', (self.stage, image_id))
+        self._db.execute('INSERT OR REPLACE INTO fired VALUES (?, ?, ?)', (self.stage, image_id, time.time()))
+        self._db.execute('COMMIT')
+
+    def forget_fired(self, max_age=JOIN_FIRED_RETENTION):
+        self._db.execute('DELETE FROM fired WHERE stage = ? AND fired_at < ?', (self.stage, time.time() - max_age))
+
+def run_join(name, branches, in_queue, out_queues, host=RABBITMQ_HOST, broker=None):
+    """ Aggregator: store the branch messages of a job (see JoinStore) and ack them,
+    until every branch has arrived. The job is then published once; the branch
+    that completed it is acked, and the job marked completed, after the broker
+    confirms it, so a crash only causes a redelivery. The jobs waiting for a
+    branch are not held in the prefetch window, so any backlog can be joined"""
+    signal.signal(signal.SIGTERM, consumer.interrupt)
+    broker = broker or transport.connect(host)
+    for queue_name in [in_queue] + out_queues:
+        broker.declare(queue_name)
+    store = JoinStore(name)
+
+    def fire(image_id, deliveries):
+        parts = store.branches(image_id)
+        event = aggregate(image_id, {b: parts[b][0] if b in parts else None for b in branches})
+        # the join continues the trace of the branch that arrived last (its critical path)
+        last = max(parts.values(), key=lambda p: p[0].get('enqueued_at') or 0)
+        trace_id, parent_id = tracing.parse(last[1])
+        span_id = tracing.new_id()
+        started = min(p[0].get('enqueued_at') or time.time() for p in parts.values())
+        tracing.record([tracing.span(trace_id, span_id, parent_id, image_id, name, 'stage',
+                                     started, time.time() - started)])
+        event['enqueued_at'] = time.time()
+        broker.forward_many(out_queues, event, deliveries, tracing.headers(trace_id, span_id),
+                            functools.partial(store.fired, image_id))
+        metrics.JOBS.inc(stage=name, outcome='ok' if event['status'] == 'done' else 'failed')
+        print(f"Joined {len(parts)}/{len(branches)} branch(es) of {image_id}")
+
+    def on_message(message, delivery, headers):
+        image_id = message['image_id']
+        if store.has_fired(image_id):
+            # a branch later than JOIN_TIMEOUT, the job was completed without it
+            broker.ack(delivery)
+            print(f"Dropped late branch {message.get('from_stage')} of {image_id}")
+            return
+        store.add(image_id, message.get('from_stage'), message, headers)
+        if set(branches) <= set(store.branches(image_id)):
+            fire(image_id, [delivery])
+        else:
+            broker.ack(delivery)
+
+    def expire():
+        for image_id in store.expired(JOIN_TIMEOUT):
+            fire(image_id, [])
+        store.forget_fired()
+
+    def expire_loop():
+        while True:
+            time.sleep(min(JOIN_TIMEOUT, 5))
+            broker.call_soon_threadsafe(expire)
+
+    threading.Thread(target=expire_loop, daemon=True).start()
+    broker.consume(in_queue, on_message, JOIN_PREFETCH)
+    print(f"Aggregating {', '.join(branches)} from {in_queue}. To exit press CTRL+C")
+    try:
+        broker.run()
+    finally:
+        broker.close()
+
+def run(spec, group, in_queues, out_queues):
+    """ Run one process group of the spec (blocks)"""
+    configure(spec, group)
+    stages = spec['stages']
+    name = '+'.join(group)
+    if stages[group[0]].get('aggregate'):
+        run_join(name, predecessors(spec)[group[0]], in_queues[0][0], out_queues)
+        return
+    workers = max(stages[s].get('workers', consumer.WORKER_COUNT) for s in group)
+    handler = functools.partial(run_group, tuple(group), out_queues == [job_store.FINAL_QUEUE])
+    failed_queue, branch = failure_target(spec, group)
+    consumer.run_consumer(in_queues, out_queues, handler, host=RABBITMQ_HOST,
+                          prefetch=2 * workers, workers=workers, worker_type=consumer.WORKER_TYPE,
+                          stage=name, initializer=configure, initargs=(spec, group),
+                          failed_queue=failed_queue,
+                          failure=consumer.failure_event if branch is None else
+                          functools.partial(branch_failure, branch))
+
+def run_forever(spec, group, in_queues, out_queues):
+    print(f"Stage {'+'.join(group)} starting, Waiting for messages...")
+    while True:
+        try:
+            run(spec, group, in_queues, out_queues)
+        except transport.CONNECTION_ERRORS:
+            print("Error: Unable to connect to RabbitMQ server. Is it running? Retrying in 5 seconds...")
+            time.sleep(5)
+        except KeyboardInterrupt:
+            print("Interrupted by user, stopping stage...")
+            sys.exit(0)
+
+def print_plan(wiring):
+    for group, in_queues, out_queues in wiring:
+        print(f" {' + '.join(group):<28} {', '.join(q for q, _ in in_queues):<34} -> {', '.join(out_queues)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a pipeline declared in a spec file")
+    parser.add_argument('--spec', default=PIPELINE_SPEC, help="pipeline spec (JSON)")
+    parser.add_argument('--plan', action='store_true', help="print the process groups and exit")
+    parser.add_argument('--stage', help="run only the process group of this stage (one per terminal or host)")
+    args = parser.parse_args()
+    try:
+        spec = load_spec(args.spec)
+    except (OSError, ValueError) as e:
+        print(f"Invalid pipeline spec {args.spec}: {e}")
+        sys.exit(1)
+    wiring = plan(spec)
+    print_plan(wiring)
+    if args.plan:
+        return
+    if args.stage:
+        selected = [w for w in wiring if args.stage in w[0]]
+        if not selected:
+            print(f"No stage {args.stage} in {args.spec}")
+            sys.exit(1)
+        run_forever(spec, *selected[0])
+        return
+    # one process per group on this host
+    processes = [multiprocessing.Process(target=run_forever, args=(spec,) + w, name='+'.join(w[0]))
+                 for w in wiring]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping pipeline...")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import metrics
+
+#------configuration------
+PROFILE_JOBS = 20 # jobs profiled per request (SIGUSR1, or POST /profile?jobs=N on the metrics port)
+PROFILE_DIR = './profiles/'
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between two stack samples
+PROFILE_CPROFILE = True # deterministic profile of the handler, on top of the samples
+PROFILE_TRACEMALLOC = True # allocations of the profiled jobs
+PROFILE_TRACEMALLOC_FRAMES = 10 # frames kept per allocation
+PROFILE_TOP_ALLOCATIONS = 30 # allocation sites written per session
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None) # not on Windows
+#-------------------------
+
+# A session profiles the next N jobs of a filter process, writes
+#   <stage>-<pid>-<time>.collapsed    stack samples, one "frame;frame;... count" per line
+#                                     (flamegraph.pl, speedscope), under a 'worker' root for
+#                                     the handler and a 'consumer' root for the consuming
+#                                     thread (receive, publish, ack)
+#   <stage>-<pid>-<time>.pstats       cProfile of the handlers (python -m pstats, snakeviz)
+#   <stage>-<pid>-<time>.alloc.txt    peak traced memory per job and the allocation sites
+#                                     still holding memory when the job ended
+# to PROFILE_DIR and turns itself off. Jobs that are not profiled pay nothing.
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """ Samples the stack of one thread from a background thread"""
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {} # collapsed stack -> samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+#------Worker side -----#
+_tracemalloc_users = 0 # profiled jobs running in this process (thread workers share it)
+_tracemalloc_lock = threading.Lock()
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        _tracemalloc_users += 1
+        tracemalloc.reset_peak()
+        return tracemalloc.take_snapshot()
+
+def _stop_tracemalloc(before):
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    sites = []
+    for stat in after.compare_to(before, 'traceback')[:PROFILE_TOP_ALLOCATIONS]:
+        if stat.size_diff > 0:
+            sites.append((stat.size_diff, stat.count_diff, '\n'.join(stat.traceback.format())))
+    return peak, sites
+
+class _Stats:
+    """ cProfile stats as pstats.Stats loads them (create_stats() and .stats)"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def run_profiled(handler, message, job_id=None):
+    """ metrics.run_measured(handler, message) under the profilers, in a worker.
+    The profile travels back in the record, as record['profile']"""
+    profile = {'job': job_id, 'samples': {}, 'stats': None, 'peak': None, 'allocations': []}
+    sampler = StackSampler(threading.get_ident()).start()
+    before = _start_tracemalloc() if PROFILE_TRACEMALLOC else None
+    profiler = None
+    if PROFILE_CPROFILE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None # another thread worker is being profiled (one profiler per process)
+    try:
+        result, record = metrics.run_measured(handler, message)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            profile['stats'] = profiler.stats
+        if before is not None:
+            profile['peak'], profile['allocations'] = _stop_tracemalloc(before)
+        profile['samples'] = sampler.stop()
+    record['profile'] = profile
+    return result, record
+
+#------Consumer side -----#
+class Profiler:
+    """ Profiling sessions of a consumer. request() may be called from any thread or
+    a signal handler; the other methods run on the consuming thread"""
+
+    def __init__(self, stage, consumer_thread_id):
+        self.stage = stage
+        self.consumer_thread_id = consumer_thread_id
+        self.requested = 0 # jobs still to start under the profilers
+        self.running = 0 # profiled jobs not finished yet
+        self.profiles = []
+        self.sampler = None
+        self.started_at = None
+
+    def request(self, jobs=PROFILE_JOBS):
+        self.requested = max(int(jobs), 0)
+        return f"Profiling the next {self.requested} job(s) of {self.stage} (pid {os.getpid()})"
+
+    def take(self):
+        """ Whether the job being submitted is profiled"""
+        if not self.requested:
+            return False
+        if self.sampler is None:
+            self.sampler = StackSampler(self.consumer_thread_id).start()
+            self.started_at = time.time()
+            print(f"Profiling started for {self.requested} job(s)")
+        self.requested -= 1
+        self.running += 1
+        return True
+
+    def job_done(self, future):
+        """ Collect the profile of a finished profiled job (none if it raised).
+        Returns True when it was the last one of the session"""
+        self.running -= 1
+        try:
+            profile = future.result()[1].pop('profile', None)
+        except BaseException:
+            profile = None
+        if profile is not None:
+            self.profiles.append(profile)
+        return not self.running and not self.requested
+
+    def dump(self):
+        """ Write the files of the session and turn the profilers off"""
+        if self.sampler is None or self.running or self.requested:
+            return None
+        consumer_samples = self.sampler.stop()
+        profiles, self.profiles, self.sampler = self.profiles, [], None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{self.stage}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        samples = {}
+        for profile in profiles:
+            for stack, count in profile['samples'].items():
+                samples['worker;' + stack] = samples.get('worker;' + stack, 0) + count
+        for stack, count in consumer_samples.items():
+            samples['consumer;' + stack] = samples.get('consumer;' + stack, 0) + count
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in sorted(samples.items()):
+                f.write(f"{stack} {count}\n")
+        written = [base + '.collapsed']
+        stats = [_Stats(p['stats']) for p in profiles if p['stats']]
+        if stats:
+            pstats.Stats(*stats).dump_stats(base + '.pstats')
+            written.append(base + '.pstats')
+        if any(p['peak'] is not None for p in profiles):
+            self._write_allocations(base + '.alloc.txt', profiles)
+            written.append(base + '.alloc.txt')
+        print(f"Profiled {len(profiles)} job(s) in {time.time() - self.started_at:.1f}s, "
+              f"wrote {', '.join(written)}")
+        return written
+
+    def _write_allocations(self, path, profiles):
+        sites = {} # traceback -> [bytes, blocks, jobs]
+        for profile in profiles:
+            for size, count, traceback in profile['allocations']:
+                site = sites.setdefault(traceback, [0, 0, 0])
+                site[0] += size
+                site[1] += count
+                site[2] += 1
+        with open(path, 'w') as f:
+            f.write("Peak traced memory per job\n")
+            for profile in profiles:
+                if profile['peak'] is not None:
+                    f.write(f"  {profile['peak'] / 2**20:10.1f} MiB  {profile['job']}\n")
+            f.write("\nMemory still allocated at the end of the jobs, by allocation site\n")
+            ranked = sorted(sites.items(), key=lambda item: -item[1][0])[:PROFILE_TOP_ALLOCATIONS]
+            for traceback, (size, count, jobs) in ranked:
+                f.write(f"\n{size / 2**10:.1f} KiB in {count} block(s), {jobs} job(s)\n{traceback}\n")
+
+def install(profiler):
+    """ Let the signal and the metrics port start a session of profiler"""
+    metrics.CONTROLS['/profile'] = lambda query: profiler.request(query.get('jobs', PROFILE_JOBS))
+    if PROFILE_SIGNAL is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(PROFILE_SIGNAL, lambda signum, frame: profiler.request())
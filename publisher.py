@@ -0,0 +1,194 @@
+import pika
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+POOL_SIZE = 4 # long-lived connections kept by the pump
+HEARTBEAT = 60 # seconds, negotiated with the broker
+CONFIRM_TIMEOUT = 10 # seconds to wait for the broker to confirm a batch
+# Broker-side bound on a queue's length, e.g. {'upload_queue': 10000}. Once a queue is
+# full the broker refuses new messages (nacks them) instead of growing until its
+# memory alarm blocks every publisher. Every process declares the queues with the
+# same arguments; an existing queue must be deleted to add or change its limit
+QUEUE_MAX_LENGTH = {}
+#-------------------------
+
+class PublishError(Exception):
+    """Raised when the broker nacks a message or does not confirm it in time."""
+
+class PublishRejected(PublishError):
+    """Raised when the broker nacks a message, e.g. because its queue is full."""
+
+def queue_arguments(queue_name):
+    """ Declaration arguments of a queue (see QUEUE_MAX_LENGTH)"""
+    if queue_name not in QUEUE_MAX_LENGTH:
+        return None
+    return {'x-max-length': QUEUE_MAX_LENGTH[queue_name], 'x-overflow': 'reject-publish'}
+
+class Publisher:
+    """ One long-lived connection and channel in publisher-confirm mode.
+    Not thread safe: a publisher is used by one thread at a time (see PublisherPool)"""
+
+    def __init__(self, host, queues):
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=host, heartbeat=HEARTBEAT))
+        self.channel = self.connection.channel()
+        # Declare the topology once per connection instead of once per message
+        for queue_name in queues:
+            self.channel.queue_declare(queue=queue_name, durable=True,
+                                       arguments=queue_arguments(queue_name))
+        self._published = 0 # delivery tags are numbered from 1 per channel
+        self._pending = set()
+        self._nacked = set()
+        # BlockingChannel.confirm_delivery would wait for every single publish.
+        # Enabling confirms on the underlying channel lets a whole batch be
+        # published and then waited for once.
+        selected = []
+        self.channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_confirm, callback=selected.append)
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+
+    def _on_confirm(self, frame):
+        """Called by pika for every Basic.Ack / Basic.Nack from the broker."""
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            tags = {t for t in self._pending if t <= tag}
+        else:
+            tags = {tag}
+        self._pending -= tags
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            self._nacked |= tags
+
+    def is_healthy(self):
+        """Services heartbeats and reports whether the connection is still usable."""
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError:
+            return False
+        return self.connection.is_open and self.channel.is_open
+
+    def publish_batch(self, routing_key, bodies, properties=None, headers=None):
+        """ Publish all bodies, then wait once for the broker to confirm them all.
+        headers, when given, holds the headers of each body (e.g. its trace context)"""
+        self._nacked.clear()
+        for body, body_headers in zip(bodies, headers or [None] * len(bodies)):
+            body_properties = properties
+            if body_properties is None:
+                # make message persistent
+                body_properties = pika.BasicProperties(delivery_mode=2, headers=body_headers)
+            self.channel.basic_publish(exchange='', routing_key=routing_key,
+                                       body=body, properties=body_properties)
+            self._published += 1
+            self._pending.add(self._published)
+        deadline = time.monotonic() + CONFIRM_TIMEOUT
+        while self._pending:
+            if time.monotonic() > deadline:
+                self._pending.clear()
+                raise PublishError(f"Broker did not confirm messages within {CONFIRM_TIMEOUT}s")
+            self.connection.process_data_events(time_limit=0.05)
+        if self._nacked:
+            raise PublishRejected(f"Broker rejected {len(self._nacked)} message(s)")
+
+    def publish(self, routing_key, body, properties=None, headers=None):
+        """ Publish one message and wait for its confirm"""
+        self.publish_batch(routing_key, [body], properties, [headers])
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+class PublisherPool:
+    """ A pool of long-lived, health-checked publishers shared by request threads.
+    Connections are opened lazily, so the pump starts even if RabbitMQ is down"""
+
+    def __init__(self, host=RABBITMQ_HOST, queues=(), size=POOL_SIZE):
+        self.host = host
+        self.queues = tuple(queues)
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._keepalive = None
+
+    def _acquire(self):
+        # Reuse an idle publisher, open a new one while under the limit, else wait
+        while True:
+            try:
+                publisher = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if not can_create:
+                    try:
+                        publisher = self._idle.get(timeout=1)
+                    except queue.Empty:
+                        continue # a slot may have been freed by a discarded publisher
+                else:
+                    try:
+                        return Publisher(self.host, self.queues)
+                    except Exception:
+                        self._discard(None)
+                        raise
+            if publisher.is_healthy():
+                return publisher
+            print(" Dropping broken RabbitMQ connection from the pool")
+            self._discard(publisher)
+
+    def _discard(self, publisher):
+        if publisher is not None:
+            publisher.close()
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def publisher(self):
+        """ Check out a publisher; it is returned to the pool unless an error occurred"""
+        self._start_keepalive()
+        publisher = self._acquire()
+        try:
+            yield publisher
+        except Exception:
+            self._discard(publisher)
+            raise
+        self._idle.put(publisher)
+
+    def publish(self, routing_key, body, properties=None, headers=None):
+        with self.publisher() as publisher:
+            publisher.publish(routing_key, body, properties, headers)
+
+    def publish_batch(self, routing_key, bodies, properties=None, headers=None):
+        with self.publisher() as publisher:
+            publisher.publish_batch(routing_key, bodies, properties, headers)
+
+    def _start_keepalive(self):
+        with self._lock:
+            if self._keepalive is None:
+                self._keepalive = threading.Thread(target=self._keepalive_loop, daemon=True)
+                self._keepalive.start()
+
+    def _keepalive_loop(self):
+        """ Idle BlockingConnections only answer heartbeats when they process events,
+        so periodically health-check the idle ones and drop the dead ones"""
+        while True:
+            time.sleep(HEARTBEAT / 4)
+            checked = []
+            while True:
+                try:
+                    publisher = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if publisher.is_healthy():
+                    checked.append(publisher)
+                else:
+                    self._discard(publisher)
+            for publisher in checked:
+                self._idle.put(publisher)
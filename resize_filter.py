@@ -1,91 +1,302 @@
-import pika
-import json
+import math
 import os
 import sys
 from PIL import Image
 import time
+import consumer
+import ingest
+import transport
+import result_cache
+import metrics
+import storage
+import shm_handoff
+import strips
 
 #------configuration------
 RABBITMQ_HOST = 'localhost'
-IN_QUEUE = 'upload_queue' #Queue to listin
+IN_LANES = ingest.LANE_WEIGHTS #Queues to listen: small and large uploads, weighted (see ingest.py)
 OUT_QUEUE = 'watermark_queue' #watermark_queue' #queue to publish for next filter
 RESIZE_FOLDER='./resized_images/'
-RESIZE_WIDTH= 640
+RESIZE_WIDTH= 640 # main rendition, written under the job's own name
+# Renditions produced from one decode, e.g. [1920, 1280, 640, 320, 160] for a full
+# pyramid. The largest is resized from the original and every smaller one from the
+# level above it. Others are named <id>_<width>w.<ext>
+RESIZE_WIDTHS = [RESIZE_WIDTH]
+RESIZE_QUALITY = 'balanced' # 'best' (full decode), 'balanced' or 'fast'
+# quality -> (JPEG draft headroom, LANCZOS reducing_gap)
+# The draft headroom is how many times larger than the target the JPEG decoder
+# must keep the image (DCT scaling by 1/2, 1/4 or 1/8). reducing_gap first
+# shrinks with a cheap box reduce and then refines with LANCZOS.
+RESIZE_QUALITY_SETTINGS = {
+    'best': (None, None),
+    'balanced': (2, 3.0),
+    'fast': (1, 2.0),
+}
+# Concurrency of this filter process (see consumer.py)
+WORKER_COUNT = consumer.WORKER_COUNT
+WORKER_TYPE = consumer.WORKER_TYPE
+PREFETCH_COUNT = consumer.PREFETCH_COUNT
+METRICS_PORT = 9101 # http://localhost:9101/metrics
+# 'file' writes the resized image to RESIZE_FOLDER, 'shm' hands the raw pixels to the
+# next filter in shared memory (no encode/decode, next filter must run on this host)
+HANDOFF_MODE = 'file'
+MEMORY_BUDGET = consumer.WORKER_MEMORY_BUDGET # bytes of decoded pixels one job may hold
+# An input over the budget (read from its header) is decoded from a smaller JPEG draft,
+# or resized strip by strip when the file is stored uncompressed. Anything else is
+# 'reject'ed or 'reroute'd to OVERSIZE_QUEUE (see large_resize_filter.py)
+OVERSIZE_ACTION = 'reject'
+OVERSIZE_QUEUE = 'upload_large_queue'
 # ensure folder exists
 os.makedirs(RESIZE_FOLDER, exist_ok=True)
+# results are memoized by (input content, parameters below); this is the key of
+# RESIZE_WIDTH resized straight from the original (shared with fused_filter.py)
+cache = result_cache.StageCache('resize', {'width': RESIZE_WIDTH, 'quality': RESIZE_QUALITY})
 #-------------------------
-def resize_image(in_path,out_path,new_width):
-    """ Resize image to new width"""
+def draft(img,new_width,quality=RESIZE_QUALITY):
+    """ Ask the JPEG decoder to downscale while decoding (DCT scaling).
+    Only takes effect before the pixels are loaded"""
+    headroom, _ = RESIZE_QUALITY_SETTINGS[quality]
+    if headroom and img.format == 'JPEG':
+        new_height = int(img.size[1] * new_width / float(img.size[0]))
+        img.draft(img.mode, (new_width * headroom, new_height * headroom))
+
+def resize(img,new_width,quality=RESIZE_QUALITY):
+    """ Resize an in-memory image to new width, keeping the aspect ratio.
+    For a JPEG that is not decoded yet, the decoder is asked to downscale first.
+    An image that is not wider than new_width is returned as it is: upscaling
+    costs CPU and only gives a blurrier image"""
+    if img.size[0] <= new_width:
+        return img
+    #Calculate new height to maintain asprect ratio
+    w_percent = (new_width / float(img.size[0]))
+    new_height = int((float(img.size[1]) * float(w_percent)))
+    draft(img,new_width,quality)
+    _, reducing_gap = RESIZE_QUALITY_SETTINGS[quality]
+    if strips.worth_splitting(img.size):
+        return resize_parallel(img,new_width,new_height,reducing_gap)
+    return img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+
+def resize_parallel(img,new_width,new_height,reducing_gap):
+    """ Resize on the strip threads: each thread produces a band of output rows from
+    the matching source box. Resampling a box still reads the pixels around it, so
+    the bands join without seams. The box reduce of reducing_gap is done once on the
+    whole image, as Image.resize does it: a band reduced on its own would start its
+    blocks elsewhere. The result matches a full resize to within one level, from the
+    rounding of the band boxes"""
+    img.load()
+    width, height = img.size
+    factor_x = factor_y = 1
+    if reducing_gap is not None:
+        factor_x = int(width / new_width / reducing_gap) or 1
+        factor_y = int(height / new_height / reducing_gap) or 1
+    if factor_x > 1 or factor_y > 1:
+        img = img.reduce((factor_x, factor_y))
+    scale = height / float(new_height) / factor_y
+    def band(y0, y1, top, bottom):
+        return img.resize((new_width, y1 - y0), Image.Resampling.LANCZOS,
+                          box=(0, y0 * scale, width / factor_x, y1 * scale))
+    return strips.stitch((new_width, new_height), strips.map_bands(new_height, band))
+
+def resize_pyramid(img,widths,quality=RESIZE_QUALITY):
+    """ Resize an in-memory image to every width, largest first. Each level is
+    reduced from the previous one, so the cost is dominated by the first level.
+    Yields (width, image)"""
+    for width in sorted(set(widths), reverse=True):
+        img = resize(img,width,quality)
+        yield width, img
+
+def resize_strips(in_path,img,new_width,budget=MEMORY_BUDGET):
+    """ Resize an image stored in row strips without decoding all of it: each band
+    of output rows is resampled from only the source rows it needs (plus the
+    LANCZOS support around them), so the result is the same as a full resize"""
+    width, height = img.size
+    new_height = int(height * new_width / float(width))
+    scale = height / float(new_height)
+    margin = strips.margin_for(scale)
+    # a band of source rows (and a resampled copy) must fit in the budget
+    rows = strips.rows_within(budget, width, img.mode)
+    out = None
+    for y0, y1, _, _ in strips.bands(new_height, int((rows - 2 * margin) / scale)):
+        top = max(int(y0 * scale) - margin, 0)
+        bottom = min(int(math.ceil(y1 * scale)) + margin, height)
+        band = strips.load_rows(in_path, top, bottom)
+        part = band.resize((new_width, y1 - y0), Image.Resampling.LANCZOS,
+                           box=(0, y0 * scale - top, width, y1 * scale - top))
+        if out is None:
+            out = Image.new(part.mode, (new_width, new_height))
+        out.paste(part, (0, y0))
+    return out
+
+def decode_within_budget(img,in_path,new_width,budget=MEMORY_BUDGET):
+    """ Decode an opened image for a resize to new_width, keeping the decoded pixels
+    under the budget. Only the header is read before deciding. Returns the decoded
+    image, already resized when it had to be processed in strips"""
+    draft(img,new_width)
+    if strips.decoded_bytes(img.size, img.mode) <= budget:
+        img.load()
+        return img
+    if img.format == 'JPEG':
+        # decode at the smallest DCT scale that is still new_width wide. The file is
+        # ours, not the image's: it is closed here and the loaded pixels outlive it
+        with open(in_path, 'rb') as f:
+            small = Image.open(f)
+            draft(small,new_width,'fast')
+            if strips.decoded_bytes(small.size, small.mode) <= budget:
+                small.load()
+                return small
+    if strips.row_tiles(img):
+        print(f"Resizing {in_path} in strips ({img.size[0]}x{img.size[1]})")
+        return resize_strips(in_path,img,new_width,budget)
+    if OVERSIZE_ACTION == 'reroute':
+        raise consumer.Reroute(OVERSIZE_QUEUE)
+    strips.check_budget(img, budget)
+    return img
+
+def resize_renditions(in_path,widths,output):
+    """ Decode the image once and resize it to every width. output(width, img)
+    stores one level (encode to a file, copy to shared memory)"""
     try:
-        with Image.open(in_path) as img:
-            #Calculate new height to maintain asprect ratio
-            w_percent = (new_width / float(img.size[0]))
-            new_height = int((float(img.size[1]) * float(w_percent)))
-            #Resize and save image
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            img.save(out_path)
-            print(f"Resized {in_path} saved to {out_path}")
+        with storage.open_image(in_path) as img:
+            with metrics.phase('decode'):
+                img = decode_within_budget(img,in_path,max(widths),MEMORY_BUDGET)
+            levels = []
+            with metrics.phase('transform'):
+                for width, level in resize_pyramid(img,widths):
+                    levels.append((width, level))
+            with metrics.phase('encode'):
+                for width, level in levels:
+                    output(width, level)
+            print(f"Resized {in_path} to width(s) {', '.join(str(w) for w, _ in levels)}")
             return True
+    except consumer.Reroute:
+        raise
     except Exception as e:
         print(f"Error resizing image {in_path}: {e}")
         return False
-    
-def callback(ch,method, properties,body):
-    """ This function is called everytim a message is received from IN_QUEUE """
-    print(f"\nReceived message..")
-    try:
-        # 1. Parse the job message
-        message = json.loads(body)
-        image_id = message['image_id']
-        image_path = message['original_path']
-        print(f"Processing image_id: {image_id}, image_path: {image_path}")
-        # 2. Define the new output path
-        resized_path= os.path.join(RESIZE_FOLDER,image_id)
-        # 3. Perform the work (the filter logic)
-        if resize_image(image_path,resized_path,RESIZE_WIDTH):
-            # 4 create bext job message      
-            new_message={
-                'image_id':image_id,
-                'original_path':image_path,
-                'resized_path':resized_path
-            }
-            # Publish to the next queue (for watermarking fillter)
-            ch.queue_declare(queue=OUT_QUEUE, durable=True)
-            ch.basic_publish(
-                exchange='',
-                routing_key=OUT_QUEUE,
-                body=json.dumps(new_message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ))
-            print(f"Published resized image job to {OUT_QUEUE} for {image_id}")
-        else:
-            print(f"Failed to resize image {image_id}")
 
-        #6. Acknowledge message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        print(f"Message acknowledged from: {IN_QUEUE}")
-    except Exception as e:
-        print(f"Error processing message: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)# need to discard bad message
+def rendition_name(image_id,width):
+    """ File name of one rendition, the RESIZE_WIDTH one keeps the job's name"""
+    if width == RESIZE_WIDTH:
+        return image_id
+    stem, ext = os.path.splitext(image_id)
+    return f"{stem}_{width}w{ext}"
+
+def rendition_cache(width,widths):
+    """ Cache of one pyramid level. A level reduced from larger ones has slightly
+    different pixels than a direct resize, so the chain is part of its parameters"""
+    params = {'width': width, 'quality': RESIZE_QUALITY}
+    larger = sorted((w for w in set(widths) if w > width), reverse=True)
+    if larger:
+        params['reduced_from'] = larger
+    return result_cache.StageCache('resize', params)
+
+def pass_through(image_path,info,rendition):
+    """ Hard link (or copy) the upload as a rendition it is already small enough
+    for: no decode, no resampling, no re-encode. info is the header probe of the
+    upload (see ingest.probe). False when the rendition needs a resize, or when its
+    file name asks for another format than the upload's"""
+    if info is None or info['width'] > rendition['width']:
+        return False
+    ext = os.path.splitext(rendition['path'])[1].lower()
+    if Image.registered_extensions().get(ext) != info['format']:
+        return False
+    result_cache.link_or_copy(image_path, rendition['path'])
+    return True
+
+def job_message(message,renditions):
+    """ Next job message: every rendition, plus the main one as resized_path/resized_shm"""
+    image_id = message['image_id']
+    main = next((r for r in renditions if r['name'] == image_id), renditions[0])
+    next_message = {
+        'image_id':image_id,
+        'original_path':message['original_path'],
+        'content_key':main['content_key'],
+        'renditions':renditions,
+        # deleted once the job is finished (see storage.py)
+        'intermediates':storage.with_intermediates(message, [r['path'] for r in renditions if 'path' in r])
+    }
+    if 'shared' in main:
+        next_message['resized_shm'] = main['shared']
+    else:
+        next_message['resized_path'] = main['path']
+    return next_message
+
+def job_renditions(message):
+    """ Renditions of a job message, for the next filters. A message with only
+    resized_path (or resized_shm) counts as one rendition"""
+    if 'renditions' in message:
+        return message['renditions']
+    rendition = {'name': message['image_id'], 'content_key': message.get('content_key')}
+    if 'resized_shm' in message:
+        rendition['shared'] = message['resized_shm']
+    else:
+        rendition['path'] = message['resized_path']
+    return [rendition]
+
+def process(message):
+    """ Filter logic for one job, runs on a worker. Returns the next job message or None"""
+    image_id = message['image_id']
+    image_path = message['original_path']
+    print(f"Processing image_id: {image_id}, image_path: {image_path}")
+    # 1. Define the renditions: output path and cache key of every width
+    input_key = result_cache.content_key(message, image_path)
+    # header read by the pump, so no stage has to open the upload to learn it
+    info = message.get('probe') or ingest.probe(image_path)
+    renditions = []
+    for width in sorted(set(RESIZE_WIDTHS), reverse=True):
+        name = rendition_name(image_id,width)
+        path = storage.path(RESIZE_FOLDER,name)
+        key = rendition_cache(width,RESIZE_WIDTHS).key(input_key, path)
+        renditions.append({'width':width, 'name':name, 'path':path, 'content_key':key})
+    # 2. Perform the work (the filter logic)
+    if HANDOFF_MODE == 'shm':
+        # the pixels go to shared memory, nothing is written to disk or cached
+        refs = {}
+        def output(width, img):
+            refs[width] = shm_handoff.export_image(img)
+        ok = resize_renditions(image_path,RESIZE_WIDTHS,output)
+        if not ok:
+            shm_handoff.release(refs)
+        for rendition in renditions:
+            del rendition['path']
+            if ok:
+                rendition['shared'] = refs[rendition['width']]
+    else:
+        # renditions the upload already fits are the upload itself, the same content
+        todo = []
+        for r in renditions:
+            if pass_through(image_path,info,r):
+                r['content_key'] = input_key
+            else:
+                todo.append(r)
+        if len(todo) < len(renditions):
+            print(f"Passed {image_id} through for width(s) "
+                  f"{', '.join(str(r['width']) for r in renditions if r not in todo)}")
+        if all(rendition_cache(r['width'],RESIZE_WIDTHS).fetch(r['content_key'], r['path'])
+               for r in todo):
+            # unless the same input was already resized
+            if todo:
+                print(f"Cache hit, reused resized image(s) for {image_id}")
+            ok = True
+        else:
+            paths = {r['width']: r['path'] for r in todo}
+            ok = resize_renditions(image_path,list(paths),lambda width, img: storage.save_image(img, paths[width]))
+            if ok:
+                for r in todo:
+                    rendition_cache(r['width'],RESIZE_WIDTHS).store(r['content_key'], r['path'])
+    if ok:
+        # 3. create next job message for the watermarking filter
+        return job_message(message,renditions)
+    print(f"Failed to resize image {image_id}")
+    return None
 
 def main():
     """ Main function to setup RabbitMQ connection and start consuming messages """
     try:
-        #1. Connect to RabbitMQ
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-        channel = connection.channel()
-        #2. Declare the input queue
-        channel.queue_declare(queue=IN_QUEUE, durable=True)# ensure input queue exists
-        print(f"Waiting for messages in {IN_QUEUE}. To exit press CTRL+C")
-        channel.queue_declare(queue=OUT_QUEUE, durable=True)# ensure output queue exists
-        #3. Set up consumer and qulaity of service
-        channel.basic_qos(prefetch_count=1) # Fair dispatch
-        # 
-        channel.basic_consume(queue=IN_QUEUE, on_message_callback=callback)
-        #4. Start consuming
-        channel.start_consuming()
-    except pika.exceptions.AMQPConnectionError :
+        consumer.run_consumer(IN_LANES, OUT_QUEUE, process, host=RABBITMQ_HOST,
+                              prefetch=PREFETCH_COUNT, workers=WORKER_COUNT, worker_type=WORKER_TYPE,
+                              stage='resize', metrics_port=METRICS_PORT)
+    except transport.CONNECTION_ERRORS :
         print("Error: Unable to connect to RabbitMQ server. Is it running? Retrying in 5 seconds...")
         time.sleep(5)
         main()  # Retry connection
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import storage
+
+#------configuration------
+CACHE_ENABLED = os.environ.get('PIPELINE_RESULT_CACHE', '1') != '0' # PIPELINE_RESULT_CACHE=0 turns it off
+CACHE_FOLDER = './stage_cache/'
+CACHE_MAX_BYTES = 1024 * 1024 * 1024 # total size of all stages, least recently used evicted first
+#-------------------------
+
+def file_hash(path):
+    """ sha256 of a file's content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def content_key(message, path):
+    """ Key of a stage's input: carried in the job message by the previous stage,
+    or the hash of the file for the first stage"""
+    return message.get('content_key') or file_hash(path)
+
+def link_or_copy(src, dst):
+    """ Atomically place a hard link (or a copy across filesystems) of src at dst"""
+    with storage.atomic_path(dst) as tmp:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+
+class StageCache:
+    """ Memoizes one stage's output file by (input key, stage parameters).
+
+    Keys are chained: a stage's key becomes the next stage's input key, so only
+    the original upload is ever hashed and changing one stage's parameters
+    reruns only that stage and the ones after it"""
+
+    _size = None # bytes in CACHE_FOLDER as last counted by this process
+    _lock = threading.Lock()
+
+    def __init__(self, stage, params, folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES):
+        self.stage = stage
+        self.params = params
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def key(self, input_key, output_path):
+        # The output extension decides the encoder, so it is part of the key
+        ext = os.path.splitext(output_path)[1].lower()
+        raw = json.dumps([input_key, self.stage, self.params, ext], sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _path(self, key, output_path):
+        ext = os.path.splitext(output_path)[1].lower()
+        return os.path.join(self.folder, self.stage, key[:2], key + ext)
+
+    def fetch(self, key, output_path):
+        """ Place the cached result at output_path. Returns False on a miss.
+        On a miss a stale file at output_path is removed, so that a hard link to
+        a cache entry is never overwritten in place by the stage"""
+        if not CACHE_ENABLED:
+            return False
+        path = self._path(key, output_path)
+        try:
+            link_or_copy(path, output_path)
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            try:
+                os.remove(output_path)
+            except FileNotFoundError:
+                pass
+            return False
+        return True
+
+    def store(self, key, output_path):
+        """ Add a freshly computed output to the cache and evict if over budget"""
+        if not CACHE_ENABLED:
+            return
+        path = self._path(key, output_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(output_path, path)
+        with StageCache._lock:
+            if StageCache._size is None:
+                StageCache._size = self._disk_usage()[0]
+            else:
+                StageCache._size += os.path.getsize(path)
+            if StageCache._size > self.max_bytes:
+                self._evict()
+
+    def _disk_usage(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue # evicted by another process
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return total, entries
+
+    def _evict(self):
+        """ Delete least recently used entries until the cache is at 90% of its budget.
+        Other filter processes share the folder, so the real usage is recounted first"""
+        total, entries = self._disk_usage()
+        entries.sort()
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        StageCache._size = total
@@ -0,0 +1,101 @@
+import os
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image
+
+#------configuration------
+SHM_PREFIX = 'pipeline_' # names of the segments created by the filters
+STALE_SEGMENT_AGE = 3600 # seconds after which cleanup_stale() frees a forgotten segment
+#-------------------------
+# Pixel layouts Pillow can wrap without a copy (Image.frombuffer maps these directly).
+# RGB is stored as RGBX because Pillow keeps RGB pixels in 4 bytes internally.
+LAYOUTS = {'RGB': 'RGBX', 'RGBA': 'RGBA', 'RGBX': 'RGBX', 'L': 'L', 'CMYK': 'CMYK'}
+BYTES_PER_PIXEL = {'RGBX': 4, 'RGBA': 4, 'CMYK': 4, 'L': 1}
+
+def _open_segment(name, create=False, size=0):
+    """ Open a segment without the resource tracker owning it: the segment has to
+    outlive the producer process and is freed by the consumer after the ack"""
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def export_image(img):
+    """ Copy the pixels of img into a new named segment and return the reference
+    to put in the job message: {'shm': name, 'size': [w, h], 'layout': mode}"""
+    layout = LAYOUTS.get(img.mode)
+    if layout is None:
+        img = img.convert('RGBA')
+        layout = 'RGBA'
+    data = img.tobytes('raw', layout)
+    name = f"{SHM_PREFIX}{uuid.uuid4().hex[:16]}"
+    shm = _open_segment(name, create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return {'shm': name, 'size': list(img.size), 'layout': layout}
+
+def with_shared_image(ref, fn):
+    """ Call fn(img) with an image that wraps the segment's memory (no copy, no codec).
+    The image is read-only and must not outlive fn; fn's return value is returned"""
+    shm = _open_segment(ref['shm'])
+    try:
+        img = Image.frombuffer(ref['layout'], tuple(ref['size']), shm.buf, 'raw', ref['layout'], 0, 1)
+        try:
+            return fn(img)
+        finally:
+            # the buffer can only be unmapped once nothing points into it
+            del img
+    finally:
+        shm.close()
+
+def shm_refs(message):
+    """ Shared memory references carried anywhere in a job message"""
+    if isinstance(message, dict):
+        if isinstance(message.get('shm'), str):
+            return [message]
+        values = message.values()
+    elif isinstance(message, list):
+        values = message
+    else:
+        return []
+    return [ref for value in values for ref in shm_refs(value)]
+
+def release(message):
+    """ Free the segments of a message. Called by the transport once the message
+    is acked (see consumer.py), or after it is discarded, so a redelivered job
+    still finds its pixels"""
+    for name in {ref['shm'] for ref in shm_refs(message)}:
+        try:
+            # tracked on purpose: unlink() unregisters it from the resource tracker again
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+def cleanup_stale(max_age=STALE_SEGMENT_AGE):
+    """ Free segments whose job was lost (e.g. never published). Linux only"""
+    folder = '/dev/shm'
+    if not os.path.isdir(folder):
+        return 0
+    freed = 0
+    now = time.time()
+    for name in os.listdir(folder):
+        if not name.startswith(SHM_PREFIX):
+            continue
+        try:
+            if now - os.stat(os.path.join(folder, name)).st_mtime > max_age:
+                os.remove(os.path.join(folder, name))
+                freed += 1
+        except FileNotFoundError:
+            pass
+    return freed
+
+if __name__ == "__main__":
+    print(f"Freed {cleanup_stale()} stale shared memory segment(s)")
@@ -0,0 +1,167 @@
+import argparse
+import contextlib
+import hashlib
+import heapq
+import mmap
+import os
+import threading
+import time
+import uuid
+from PIL import Image
+
+#------configuration------
+SHARD_LEVELS = 2 # directory levels under a folder, 256 entries each
+REAP_INTERMEDIATES = True # delete the files a job passed between stages once it is finished
+REAP_UPLOADS = True # ...and its upload
+REAP_DELAY = 60 # seconds between the completion of a job and the deletion (a redelivered message still finds its files)
+# Swept by `python storage.py` for files no finished job accounted for (pump restarted
+# before the delay, jobs that never completed)
+INTERMEDIATE_FOLDERS = ['uploads', 'resized_images']
+# Only the temporary files of interrupted writes are swept here. 'blurred' holds the
+# results of the blur branch of pipeline.json, so it is not swept as an intermediate
+OUTPUT_FOLDERS = ['watermarked_images', 'blurred']
+ORPHAN_MAX_AGE = 24 * 3600 # seconds after which the sweep deletes such a file
+#-------------------------
+
+# Every artifact (upload, rendition, stage output) lives at
+#   <folder>/<h[0:2]>/<h[2:4]>/<name>   with h = sha1(name)
+# so no directory holds more than a few thousand entries whatever the number of
+# jobs, and the path of a name is known without listing anything.
+# Files are written under a temporary name in the same directory and renamed once
+# complete: a reader sees the whole file or none (a crash leaves only a .tmp- file).
+
+TMP_PREFIX = '.tmp-'
+
+def path(folder, name):
+    """ Sharded path of the file `name` in folder"""
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    shards = [digest[2 * i:2 * i + 2] for i in range(SHARD_LEVELS)]
+    return os.path.join(folder, *shards, name)
+
+def temp_path(final_path):
+    """ Temporary name next to final_path. It keeps the extension, which Pillow
+    uses to pick the encoder"""
+    folder, name = os.path.split(final_path)
+    return os.path.join(folder, f"{TMP_PREFIX}{uuid.uuid4().hex[:12]}-{name}")
+
+@contextlib.contextmanager
+def atomic_path(final_path):
+    """ Yields a temporary path to write; it is renamed to final_path when the
+    block succeeds and deleted when it raises"""
+    os.makedirs(os.path.dirname(final_path) or '.', exist_ok=True)
+    tmp = temp_path(final_path)
+    try:
+        yield tmp
+        os.replace(tmp, final_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+def save_image(img, final_path, **params):
+    """ img.save() to final_path, atomically"""
+    with atomic_path(final_path) as tmp:
+        img.save(tmp, **params)
+
+@contextlib.contextmanager
+def open_image(image_path):
+    """ Image.open() on a read-only memory map of the file: the decoder reads the
+    page cache directly instead of through read() calls and a copy per chunk"""
+    with open(image_path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file, Pillow reports it as not an image
+            mapped = None
+        with contextlib.ExitStack() as stack:
+            if mapped is not None:
+                stack.callback(mapped.close)
+            with Image.open(mapped if mapped is not None else f) as img:
+                yield img
+
+#------Reaper -----#
+class Reaper:
+    """ Deletes the intermediate files of finished jobs, REAP_DELAY seconds after
+    they finished. Runs in the pump, which records the completion events
+    (see job_store.py); the filters must share its filesystem"""
+
+    def __init__(self, delay=REAP_DELAY):
+        self.delay = delay
+        self._due = [] # heap of (deadline, paths)
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def schedule(self, paths):
+        if not paths:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._due, (time.monotonic() + self.delay, sorted(paths)))
+            self._lock.notify()
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._lock.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, paths = heapq.heappop(self._due)
+            remove(paths)
+
+def remove(paths):
+    """ Delete files, the missing ones are skipped. Returns the number deleted"""
+    removed = 0
+    for file_path in paths:
+        try:
+            os.remove(file_path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def intermediates(message):
+    """ Files written for a job so far, carried along in its messages"""
+    return list(message.get('intermediates', []))
+
+def with_intermediates(message, paths):
+    """ The intermediates of message plus paths, for the next message"""
+    return intermediates(message) + [p for p in paths if p not in message.get('intermediates', [])]
+
+def to_reap(event):
+    """ Files of a completion event that can be deleted: everything written on the
+    way to the results, except the results themselves"""
+    if not REAP_INTERMEDIATES:
+        return []
+    kept = {os.path.abspath(r['path']) for r in event.get('results', [])}
+    return [p for p in set(event.get('intermediates', [])) if os.path.abspath(p) not in kept]
+
+#------Sweep -----#
+def sweep(folders=INTERMEDIATE_FOLDERS, max_age=ORPHAN_MAX_AGE, output_folders=OUTPUT_FOLDERS):
+    """ Delete the files older than max_age in folders, and the temporary files of
+    interrupted writes in output_folders. Returns the number deleted"""
+    removed = 0
+    now = time.time()
+    for folder, temp_only in [(f, False) for f in folders] + [(f, True) for f in output_folders]:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if temp_only and not name.startswith(TMP_PREFIX):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    if now - os.stat(file_path).st_mtime > max_age:
+                        os.remove(file_path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete the intermediate files no finished job accounted for")
+    parser.add_argument('folders', nargs='*', default=INTERMEDIATE_FOLDERS, help="folders to sweep")
+    parser.add_argument('--max-age', type=float, default=ORPHAN_MAX_AGE, help="seconds")
+    args = parser.parse_args()
+    print(f"Deleted {sweep(args.folders, args.max_age)} file(s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+#------configuration------
+# bytes per pixel of Pillow's in-memory storage (3 band images are stored in 4 bytes)
+PIXEL_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+# Threads one image's resize or blur is split over (1 = off). Pillow releases the GIL
+# while resampling and filtering, so the strips run on several cores. Mind that every
+# worker of a filter has its own threads: use fewer workers when raising this
+STRIP_THREADS = 1
+MIN_SPLIT_PIXELS = 2000000 # smaller images are not worth the split
+#-------------------------
+
+_executor = None
+_executor_lock = threading.Lock()
+
+class OversizedImage(ValueError):
+    """ The image does not fit in the memory budget of a worker"""
+
+def decoded_bytes(size, mode):
+    """ Memory Pillow needs for the decoded pixels of an image"""
+    return size[0] * size[1] * PIXEL_BYTES.get(mode, 4)
+
+def check_budget(img, budget, copies=1):
+    """ Raise OversizedImage when `copies` full-size bitmaps of img (read from the
+    header, before decoding) do not fit in budget bytes"""
+    needed = decoded_bytes(img.size, img.mode) * copies
+    if needed > budget:
+        raise OversizedImage(f"{img.size[0]}x{img.size[1]} {img.mode} image needs "
+                             f"{needed >> 20} MB, the budget is {budget >> 20} MB")
+
+def bands(total, rows, margin=0):
+    """ Split `total` rows into bands of `rows` rows. Yields (y0, y1, top, bottom):
+    the band and the band grown by `margin` rows of context on each side"""
+    rows = max(1, rows)
+    for y0 in range(0, total, rows):
+        y1 = min(y0 + rows, total)
+        yield y0, y1, max(y0 - margin, 0), min(y1 + margin, total)
+
+def _raw_stride(img, rawmode):
+    try:
+        return len(Image.new(img.mode, (img.width, 1)).tobytes('raw', rawmode))
+    except Exception:
+        return None
+
+def row_tiles(img):
+    """ The decoder tiles of an image that is not loaded yet, as full-width row ranges
+    that can be decoded on their own: [(y0, y1, tile)]. Uncompressed files (raw TIFF
+    strips, BMP, PPM) can be cut at any row. None when the file can only be decoded
+    as a whole (JPEG, PNG, compressed TIFF, ...)"""
+    if img.getexif().get(0x0112, 1) != 1:
+        return None # rotated on load, the rows on disk are not the image rows
+    tiles = []
+    for tile in img.tile:
+        codec, (x0, y0, x1, y1), offset, args = tile
+        if x0 != 0 or x1 != img.width or codec != 'raw':
+            return None
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else args
+        stride = stride or _raw_stride(img, rawmode)
+        if stride is None or orientation not in (1, -1):
+            return None
+        tiles.append((y0, y1, (codec, (x0, y0, x1, y1), offset, (rawmode, stride, orientation))))
+    return tiles or None
+
+def _cut(tile, top, bottom):
+    """ The part of a raw tile covering rows [top, bottom)"""
+    codec, (x0, y0, x1, y1), offset, args = tile
+    top, bottom = max(top, y0), min(bottom, y1)
+    rawmode, stride, orientation = args
+    # bottom-up files (BMP) store the last row first
+    skip = top - y0 if orientation == 1 else y1 - bottom
+    return (codec, (x0, top, x1, bottom), offset + skip * stride, args)
+
+def load_rows(path, top, bottom):
+    """ Decode only rows [top, bottom) of an image that has row_tiles()"""
+    img = Image.open(path)
+    tiles = []
+    for y0, y1, tile in row_tiles(img):
+        if y1 > top and y0 < bottom:
+            codec, (x0, t, x1, b), offset, args = _cut(tile, top, bottom)
+            tiles.append((codec, (x0, t - top, x1, b - top), offset, args))
+    # decode as if the file only held these rows
+    img.tile = tiles
+    img._size = (img.width, bottom - top)
+    if hasattr(img, '_tile_size'):
+        img._tile_size = img._size # TIFF allocates the bitmap from its own copy
+    img.load()
+    return img
+
+def rows_within(budget, width, mode, copies=2):
+    """ Rows of a band so that `copies` bands of that width fit in the budget"""
+    return max(1, budget // (decoded_bytes((width, 1), mode) * copies))
+
+def margin_for(scale, support=3):
+    """ Rows of context a resampling filter with `support` (3 for LANCZOS) needs
+    when shrinking by `scale`"""
+    return int(math.ceil(support * max(scale, 1))) + 1
+
+def worth_splitting(size):
+    return STRIP_THREADS > 1 and size[0] * size[1] >= MIN_SPLIT_PIXELS
+
+def _strip_executor():
+    # created on first use, so each worker process gets its own threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=STRIP_THREADS)
+        return _executor
+
+def set_strip_threads(threads):
+    """ Change STRIP_THREADS at run time (the next split starts a new pool)"""
+    global STRIP_THREADS, _executor
+    with _executor_lock:
+        STRIP_THREADS = threads
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def map_bands(total, fn, margin=0):
+    """ Split `total` rows into one band per strip thread and run fn(y0, y1, top,
+    bottom) (see bands()) for each band on the strip threads. Returns [(y0, result)]"""
+    parts = list(bands(total, int(math.ceil(total / float(STRIP_THREADS))), margin))
+    results = _strip_executor().map(lambda band: fn(*band), parts)
+    return [(band[0], result) for band, result in zip(parts, results)]
+
+def stitch(size, parts):
+    """ Paste the (y0, image) strips of map_bands() into one image"""
+    out = Image.new(parts[0][1].mode, size)
+    for y0, part in parts:
+        out.paste(part, (0, y0))
+    return out
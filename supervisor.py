@@ -0,0 +1,171 @@
+import importlib
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+import consumer
+import ingest
+import metrics
+import transport
+
+#------configuration------
+RABBITMQ_HOST = 'localhost'
+# Filters run by the supervisor: the queues whose depth drives the scaling, and the
+# bounds on the number of processes of that filter
+SCALED_FILTERS = {
+    'resize': {'module': 'resize_filter', 'queues': ingest.LANES, 'min': 1, 'max': 4},
+    'blur': {'module': 'blur_filter', 'queues': ['blur_queue'], 'min': 0, 'max': 2},
+    'watermark': {'module': 'water_filter', 'queues': ['watermark_queue'], 'min': 1, 'max': 4},
+}
+WORKERS_PER_PROCESS = 2 # pool size of every supervised filter process
+CHECK_INTERVAL = 2.0 # seconds between two scaling decisions
+SCALE_UP_BACKLOG = 4 # waiting jobs per worker from which a process is added
+SCALE_UP_UTILIZATION = 0.8 # ... or busy share of the workers, when jobs are waiting
+SCALE_DOWN_UTILIZATION = 0.3 # a process is stopped when the queues are empty and below this...
+SCALE_DOWN_DELAY = 30 # ...for this many seconds (no flapping on bursty traffic)
+# Imported once by the fork server: new filter processes are forked from it with
+# Pillow and the filters already loaded, so scaling up takes milliseconds
+PRELOAD = ['PIL.Image', 'PIL.ImageFilter', 'PIL.ImageDraw', 'pika',
+           'consumer', 'metrics', 'transport'] + [f['module'] for f in SCALED_FILTERS.values()]
+METRICS_PORT = 9106 # http://localhost:9106/metrics
+#-------------------------
+
+BUSY_REPORT_INTERVAL = 0.5
+
+def _report_busy(busy, stage):
+    while True:
+        busy.value = consumer.busy_workers(stage)
+        time.sleep(BUSY_REPORT_INTERVAL)
+
+def run_filter(module_name, stage, workers, busy):
+    """ Entry point of a supervised filter process. Shares the number of its workers
+    running a job with the supervisor through `busy` (prefetched jobs waiting for a
+    worker, or jobs waiting for their confirm, do not count)"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # CTRL+C is for the supervisor, which stops us
+    module = importlib.import_module(module_name)
+    module.WORKER_COUNT = workers
+    module.PREFETCH_COUNT = 2 * workers
+    threading.Thread(target=_report_busy, args=(busy, stage), daemon=True).start()
+    module.main()
+
+class ScaledFilter:
+    """ The processes running one filter"""
+    def __init__(self, ctx, stage, module, queues, min_processes, max_processes):
+        self.ctx = ctx
+        self.stage = stage
+        self.module = module
+        self.queues = queues
+        self.min = min_processes
+        self.max = max_processes
+        self.processes = [] # [(process, busy)]
+        self.low_since = None
+
+    def start_one(self):
+        busy = self.ctx.Value('i', 0, lock=False)
+        process = self.ctx.Process(target=run_filter, name=f"{self.stage}-filter",
+                                   args=(self.module, self.stage, WORKERS_PER_PROCESS, busy))
+        process.start()
+        self.processes.append((process, busy))
+
+    def stop_one(self):
+        # the idlest one, stopped like on CTRL+C: what it still holds is nacked or redelivered
+        process, busy = min(self.processes, key=lambda p: p[1].value)
+        self.processes.remove((process, busy))
+        process.terminate()
+        process.join(timeout=30)
+
+    def reap(self):
+        """ Forget the processes that died (crash, OOM kill)"""
+        alive = [(p, b) for p, b in self.processes if p.is_alive()]
+        for process, _ in self.processes:
+            if not process.is_alive():
+                print(f"{self.stage}: filter process {process.pid} exited with {process.exitcode}")
+        self.processes = alive
+
+    def utilization(self):
+        capacity = len(self.processes) * WORKERS_PER_PROCESS
+        if not capacity:
+            return 1.0
+        return sum(min(busy.value, WORKERS_PER_PROCESS) for _, busy in self.processes) / capacity
+
+    def scale(self, depth, now):
+        """ One scaling decision from the depth of the input queues. Returns the change"""
+        self.reap()
+        count = len(self.processes)
+        utilization = self.utilization()
+        metrics.QUEUE_DEPTH.set(depth, stage=self.stage)
+        metrics.UTILIZATION.set(utilization, stage=self.stage)
+        if count < self.min:
+            target = self.min
+        elif count < self.max and (depth > SCALE_UP_BACKLOG * max(count, 1) * WORKERS_PER_PROCESS
+                                   or (depth > 0 and utilization >= SCALE_UP_UTILIZATION)):
+            target = count + 1
+        elif count > self.min and depth == 0 and utilization <= SCALE_DOWN_UTILIZATION:
+            self.low_since = self.low_since or now
+            target = count - 1 if now - self.low_since >= SCALE_DOWN_DELAY else count
+        else:
+            self.low_since = None
+            target = count
+        for _ in range(count, target):
+            self.start_one()
+        if target < count:
+            self.stop_one()
+            self.low_since = None
+        metrics.PROCESSES.set(len(self.processes), stage=self.stage)
+        return target - count
+
+    def stop(self):
+        for process, _ in self.processes:
+            process.terminate()
+        for process, _ in self.processes:
+            process.join(timeout=30)
+        self.processes = []
+
+def queue_depth(broker, queues):
+    total = 0
+    for queue in queues:
+        broker.declare(queue)
+        total += broker.queue_depth(queue)
+    return total
+
+def supervise(filters, broker):
+    while True:
+        now = time.monotonic()
+        for scaled in filters:
+            depth = queue_depth(broker, scaled.queues)
+            change = scaled.scale(depth, now)
+            if change:
+                print(f"{scaled.stage}: {len(scaled.processes)} process(es) "
+                      f"(depth {depth}, utilization {scaled.utilization():.0%})")
+        time.sleep(CHECK_INTERVAL)
+
+def main():
+    """ Run the filters of SCALED_FILTERS, each between its min and max processes """
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(PRELOAD)
+    filters = [ScaledFilter(ctx, stage, f['module'], f['queues'], f['min'], f['max'])
+               for stage, f in SCALED_FILTERS.items()]
+    metrics.start_metrics_server(METRICS_PORT)
+    signal.signal(signal.SIGTERM, consumer.interrupt) # stop the filters on `kill` too
+    print("Supervisor starting, Waiting for messages...")
+    try:
+        while True:
+            try:
+                broker = transport.connect(RABBITMQ_HOST)
+                try:
+                    supervise(filters, broker)
+                finally:
+                    broker.close()
+            except transport.CONNECTION_ERRORS:
+                print("Error: Unable to connect to RabbitMQ server. Is it running? Retrying in 5 seconds...")
+                time.sleep(5)
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping filters...")
+        for scaled in filters:
+            scaled.stop()
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import argparse
+import atexit
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+#------configuration------
+TRACING = True # record the spans of every job
+TRACE_DB = 'traces.db' # SQLite sink shared by the pump and the filters of this host
+TRACE_FLUSH_INTERVAL = 1.0 # seconds between two writes of the buffered spans
+TRACE_HEADER = 'traceparent' # W3C trace context, in the AMQP message headers
+#-------------------------
+
+# A trace is one job: the pump opens it, every stage adds a span (its parent is the
+# span of the previous stage, read from the message headers) and the spans of its
+# phases (queue_wait, decode, transform, encode, publish) under it.
+
+def new_id(length=16):
+    return os.urandom(length // 2).hex()
+
+def new_trace():
+    """ (trace id, span id) of the pump span of a new job"""
+    return new_id(32), new_id(16)
+
+def headers(trace_id, span_id):
+    """ Message headers carrying the context to the next stage"""
+    return {TRACE_HEADER: f"00-{trace_id}-{span_id}-01"}
+
+def parse(message_headers):
+    """ (trace id, parent span id) from message headers. A message without a
+    context (published by an older producer) starts a new trace"""
+    value = (message_headers or {}).get(TRACE_HEADER)
+    try:
+        _, trace_id, span_id, _ = value.split('-')
+        return trace_id, span_id
+    except (AttributeError, ValueError):
+        return new_id(32), None
+
+#------Sink -----#
+class Sink:
+    """ Spans are buffered and written by a background thread, so recording one
+    never waits for the disk"""
+
+    def __init__(self, path=TRACE_DB):
+        self.path = path
+        self._pending = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute("""CREATE TABLE IF NOT EXISTS spans (
+            trace_id TEXT, span_id TEXT, parent_id TEXT, job_id TEXT,
+            stage TEXT, name TEXT, start REAL, duration REAL)""")
+        db.execute('CREATE INDEX IF NOT EXISTS spans_trace ON spans (trace_id)')
+        return db
+
+    def record(self, spans):
+        if not TRACING:
+            return
+        with self._lock:
+            if self._thread is None:
+                # started on first use, so forked workers do not inherit a writer
+                self._thread = threading.Thread(target=self._write_loop, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        self._pending.put(spans)
+
+    def _take(self):
+        rows = []
+        while True:
+            try:
+                rows.extend(self._pending.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def flush(self, db=None):
+        rows = self._take()
+        if not rows:
+            return
+        db = db or self._connect()
+        try:
+            with db:
+                db.executemany('INSERT INTO spans VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            print(f"Tracing: could not write {len(rows)} span(s): {e}")
+
+    def _write_loop(self):
+        db = self._connect()
+        while True:
+            time.sleep(TRACE_FLUSH_INTERVAL)
+            self.flush(db)
+
+_sink = Sink()
+
+def span(trace_id, span_id, parent_id, job_id, stage, name, start, duration):
+    return (trace_id, span_id, parent_id, job_id, stage, name, start, duration)
+
+def record(spans):
+    """ Queue spans (see span()) for the sink"""
+    _sink.record(spans)
+
+#------Report -----#
+PHASES = ('save', 'probe', 'queue_wait', 'decode', 'transform', 'encode', 'publish')
+
+def load_traces(db, since=None):
+    """ {trace_id: [span rows as dicts]}"""
+    query = 'SELECT trace_id, span_id, parent_id, job_id, stage, name, start, duration FROM spans'
+    args = ()
+    if since is not None:
+        query += ' WHERE trace_id IN (SELECT trace_id FROM spans WHERE start >= ?)'
+        args = (since,)
+    traces = {}
+    names = ('trace_id', 'span_id', 'parent_id', 'job_id', 'stage', 'name', 'start', 'duration')
+    for row in db.execute(query, args):
+        row = dict(zip(names, row))
+        traces.setdefault(row['trace_id'], []).append(row)
+    return traces
+
+def critical_path(spans):
+    """ The stage spans from the pump to the stage that finished last, and the
+    end-to-end time of the job. Returns ([(stage span, [phase spans])], seconds)"""
+    by_id = {s['span_id']: s for s in spans}
+    children = {}
+    for s in spans:
+        children.setdefault(s['parent_id'], []).append(s)
+    stages = [s for s in spans if s['name'] == 'stage']
+    if not stages:
+        return [], 0.0
+    last = max(stages, key=lambda s: s['start'] + s['duration'])
+    path = []
+    node = last
+    while node is not None:
+        phases = [c for c in children.get(node['span_id'], []) if c['name'] != 'stage']
+        path.append((node, phases))
+        node = by_id.get(node['parent_id'])
+    path.reverse()
+    first = min(s['start'] for s in spans)
+    return path, last['start'] + last['duration'] - first
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+def report(db_path=TRACE_DB, slowest=10, since=None):
+    db = sqlite3.connect(db_path, timeout=30)
+    traces = load_traces(db, since)
+    jobs = []
+    for trace_id, spans in traces.items():
+        path, total = critical_path(spans)
+        if path:
+            jobs.append((total, trace_id, path))
+    if not jobs:
+        print("No complete traces recorded yet.")
+        return
+    # time on the critical path by (stage, phase)
+    shares = {}
+    for total, _, path in jobs:
+        for stage_span, phases in path:
+            for phase in phases:
+                key = (stage_span['stage'], phase['name'])
+                shares.setdefault(key, []).append(phase['duration'])
+    grand_total = sum(total for total, _, _ in jobs)
+    print("\n" + "="*72)
+    print(f" CRITICAL PATH BREAKDOWN ({len(jobs)} jobs, end-to-end p50 "
+          f"{percentile([j[0] for j in jobs], 0.5):.3f}s, p95 {percentile([j[0] for j in jobs], 0.95):.3f}s)")
+    print("="*72)
+    print(f" {'stage':<14}{'phase':<12}{'share':>8}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for (stage, name), durations in sorted(shares.items(), key=lambda item: -sum(item[1])):
+        print(f" {stage:<14}{name:<12}{sum(durations) / grand_total:>7.1%}"
+              f"{sum(durations) / len(durations):>10.3f}{percentile(durations, 0.5):>10.3f}"
+              f"{percentile(durations, 0.95):>10.3f}")
+    print("\n A large queue_wait share means the stage needs more workers (see supervisor.py);")
+    print(" a large decode/transform/encode share means its jobs are slow.")
+    print(f"\n SLOWEST {min(slowest, len(jobs))} JOBS")
+    for total, trace_id, path in sorted(jobs, key=lambda j: j[0], reverse=True)[:slowest]:
+        job_id = next((s['job_id'] for s, _ in path if s['job_id']), trace_id)
+        print(f" {total:>8.3f}s  {job_id}")
+        for stage_span, phases in path:
+            # a phase runs once per rendition
+            summed = {}
+            for p in phases:
+                summed[p['name']] = summed.get(p['name'], 0.0) + p['duration']
+            detail = '  '.join(f"{name} {seconds:.3f}" for name, seconds in
+                               sorted(summed.items(), key=lambda item: PHASES.index(item[0])
+                                      if item[0] in PHASES else len(PHASES)))
+            print(f"             {stage_span['stage']:<14}{stage_span['duration']:>7.3f}s  {detail}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Critical path and slowest jobs from the recorded traces")
+    parser.add_argument('--db', default=TRACE_DB, help="trace database")
+    parser.add_argument('--slowest', type=int, default=10, help="slowest jobs to list")
+    parser.add_argument('--last', type=float, default=None, metavar='SECONDS',
+                        help="only the jobs traced in the last SECONDS")
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        print(f"No trace database at {args.db}")
+        sys.exit(1)
+    since = time.time() - args.last if args.last else None
+    report(args.db, args.slowest, since)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import functools
+import json
+import os
+import queue
+import threading
+from multiprocessing.managers import BaseManager
+
+import pika
+
+from publisher import PublisherPool, queue_arguments
+
+#------configuration------
+# 'rabbitmq' or 'local' (multiprocessing queues served by local_broker.py, one host only)
+TRANSPORT = os.environ.get('PIPELINE_TRANSPORT', 'rabbitmq')
+RABBITMQ_HOST = 'localhost'
+LOCAL_BROKER_ADDRESS = ('localhost', 50000)
+LOCAL_BROKER_AUTHKEY = b'pipeline'
+LOCAL_POLL_INTERVAL = 0.01 # seconds a local consumer blocks on an empty queue
+# A job whose forward the broker nacked (e.g. a full queue, see publisher.QUEUE_MAX_LENGTH)
+# is requeued after this delay, doubled for each nack in a row up to REQUEUE_DELAY_MAX
+REQUEUE_DELAY = 0.5
+REQUEUE_DELAY_MAX = 30
+#-------------------------
+
+# Errors meaning "the broker is not reachable", for the filters' retry loops
+CONNECTION_ERRORS = (pika.exceptions.AMQPConnectionError, ConnectionError)
+
+class RabbitMQTransport:
+    """ Durable queues on RabbitMQ: persistent messages, acks, redelivery on crash.
+
+    The channel is in publisher-confirm mode. forward() does not wait for the broker:
+    the job it finishes is acked once the broker has confirmed the published message,
+    so a job is never lost between two stages (at-least-once). Acks of finished jobs
+    are coalesced into one Basic.Ack with multiple=True when no older job is still
+    in progress"""
+
+    def __init__(self, host=RABBITMQ_HOST):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        self.channel = self.connection.channel()
+        self._published = 0 # publish sequence numbers, from 1 per channel
+        self._awaiting = {} # publish sequence number -> forward it belongs to (see forward_many)
+        self._unsettled = set() # deliveries received, not acked or nacked yet
+        self._done = set() # deliveries finished, their ack not sent yet
+        self._after_ack = [] # on_acked callbacks of the deliveries in _done
+        self._nacks_in_row = 0 # publishes nacked since the last confirmed one
+        # as in publisher.Publisher: BlockingChannel.confirm_delivery would block on
+        # every publish, the underlying channel reports the confirms as they come
+        selected = []
+        self.channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_confirm, callback=selected.append)
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+
+    def declare(self, queue_name):
+        self.channel.queue_declare(queue=queue_name, durable=True, arguments=queue_arguments(queue_name))
+
+    def publish(self, queue_name, message, headers=None):
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            body=json.dumps(message),
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # make message persistent
+                headers=headers, # trace context (see tracing.py)
+            ))
+        self._published += 1
+        return self._published
+
+    def forward(self, queue_name, message, delivery, headers=None, on_acked=None):
+        """ Publish the next job of a finished delivery, ack the delivery once the
+        broker has confirmed the publish"""
+        self.forward_many([queue_name], message, [delivery], headers, on_acked)
+
+    def forward_many(self, queue_names, message, deliveries, headers=None, on_acked=None):
+        """ Publish message to every queue (fan-out), ack all the deliveries it was
+        made from (a join) once the broker has confirmed every publish. on_acked()
+        runs once they are acked; not at all when a nack of the broker requeues them"""
+        pending = {'deliveries': list(deliveries), 'left': len(queue_names), 'on_acked': on_acked}
+        for queue_name in queue_names:
+            self._awaiting[self.publish(queue_name, message, headers)] = pending
+
+    def consume(self, queue_name, on_message, prefetch):
+        """ on_message(message, delivery, headers) is called on the connection thread"""
+        def callback(ch, method, properties, body):
+            try:
+                message = json.loads(body)
+            except ValueError as e:
+                print(f"Error parsing message: {e}")
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
+            self._unsettled.add(method.delivery_tag)
+            on_message(message, method.delivery_tag, properties.headers or {})
+        # a non-global qos applies to the consumers started after it, so every
+        # consumed queue keeps its own prefetch window on the shared channel
+        self.channel.basic_qos(prefetch_count=prefetch)
+        self.channel.basic_consume(queue=queue_name, on_message_callback=callback)
+
+    def ack(self, delivery, on_acked=None):
+        self._done.add(delivery)
+        if on_acked is not None:
+            self._after_ack.append(on_acked)
+        self._flush_acks()
+
+    def nack(self, delivery, requeue=False):
+        self._unsettled.discard(delivery)
+        self.channel.basic_nack(delivery_tag=delivery, requeue=requeue)# need to discard bad message
+
+    def _on_confirm(self, frame):
+        """ Basic.Ack / Basic.Nack of our publishes, on the connection thread"""
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            tags = [t for t in self._awaiting if t <= tag]
+        else:
+            tags = [tag]
+        nacked = isinstance(frame.method, pika.spec.Basic.Nack)
+        for pending in [self._awaiting.pop(t) for t in tags if t in self._awaiting]:
+            if pending['left'] == 0:
+                continue # already settled by a nack of another of its publishes
+            pending['left'] = 0 if nacked else pending['left'] - 1
+            if nacked:
+                # the broker lost or refused the next job: run this one again, later,
+                # so a full queue downstream is not hammered with the same jobs
+                delay = min(REQUEUE_DELAY * 2 ** self._nacks_in_row, REQUEUE_DELAY_MAX)
+                self._nacks_in_row += 1
+                self.connection.call_later(delay, functools.partial(self._requeue, pending['deliveries']))
+                continue
+            self._nacks_in_row = 0
+            if pending['left'] == 0:
+                self._done.update(pending['deliveries'])
+                if pending['on_acked'] is not None:
+                    self._after_ack.append(pending['on_acked'])
+        self._flush_acks()
+
+    def _requeue(self, deliveries):
+        for delivery in deliveries:
+            self.nack(delivery, requeue=True)
+
+    def _flush_acks(self):
+        """ Ack the finished deliveries: the ones older than every delivery still in
+        progress with one multiple ack, the others one by one"""
+        if self._done:
+            self._unsettled -= self._done
+            oldest = min(self._unsettled, default=None)
+            below = [d for d in self._done if oldest is None or d < oldest]
+            if below:
+                self.channel.basic_ack(delivery_tag=max(below), multiple=True)
+            for delivery in self._done.difference(below):
+                self.channel.basic_ack(delivery_tag=delivery)
+            self._done.clear()
+        # also those of a forward that settles no delivery (e.g. an expired join)
+        callbacks, self._after_ack = self._after_ack, []
+        for callback in callbacks:
+            callback()
+
+    def call_soon_threadsafe(self, fn):
+        """ Run fn on the connection thread (pika channels are not thread safe)"""
+        self.connection.add_callback_threadsafe(fn)
+
+    def queue_depth(self, queue_name):
+        state = self.channel.queue_declare(queue=queue_name, durable=True, passive=True)
+        return state.method.message_count
+
+    def run(self):
+        self.channel.start_consuming()
+
+    def close(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+#------Local backend -----#
+class LocalBrokerManager(BaseManager):
+    pass
+
+_local_queues = {}
+_local_queues_lock = threading.Lock()
+
+def _get_queue(name):
+    # Runs inside the local broker process
+    with _local_queues_lock:
+        return _local_queues.setdefault(name, queue.Queue())
+
+LocalBrokerManager.register('get_queue', callable=_get_queue)
+
+def serve_local_broker(address=LOCAL_BROKER_ADDRESS, authkey=LOCAL_BROKER_AUTHKEY):
+    """ Serve named queues to the pump and filters on this host (blocks)"""
+    manager = LocalBrokerManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    print(f"Local broker listening on {address[0]}:{address[1]}")
+    server.serve_forever()
+
+class LocalTransport:
+    """ Queues held in the local broker process, shared by every process on the host.
+    No persistence and a message is gone once received (at-most-once): a filter that
+    crashes loses the jobs it had in flight. Meant for single-host runs and tests"""
+
+    def __init__(self, address=LOCAL_BROKER_ADDRESS, authkey=LOCAL_BROKER_AUTHKEY):
+        self.manager = LocalBrokerManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self._queues = {}
+        self._callbacks = queue.Queue()
+        self._consuming = [] # (inbox, on_message, prefetch) per consumed queue
+        self._in_flight = []
+        self._deliveries = {} # delivery -> index in _consuming
+        self._delivery = 0
+        self._closed = False
+
+    def _queue(self, queue_name):
+        if queue_name not in self._queues:
+            self._queues[queue_name] = self.manager.get_queue(queue_name)
+        return self._queues[queue_name]
+
+    def declare(self, queue_name):
+        self._queue(queue_name)
+
+    def publish(self, queue_name, message, headers=None):
+        self.put_raw(queue_name, [json.dumps(message)], [headers])
+
+    def forward(self, queue_name, message, delivery, headers=None, on_acked=None):
+        self.forward_many([queue_name], message, [delivery], headers, on_acked)
+
+    def forward_many(self, queue_names, message, deliveries, headers=None, on_acked=None):
+        # the manager's put returns once the message is queued
+        for queue_name in queue_names:
+            self.publish(queue_name, message, headers)
+        for delivery in deliveries:
+            self.ack(delivery)
+        if on_acked is not None:
+            on_acked()
+
+    def consume(self, queue_name, on_message, prefetch):
+        self._consuming.append((self._queue(queue_name), on_message, prefetch))
+        self._in_flight.append(0)
+
+    def ack(self, delivery, on_acked=None):
+        self._in_flight[self._deliveries.pop(delivery)] -= 1
+        if on_acked is not None:
+            on_acked()
+
+    def nack(self, delivery, requeue=False):
+        self._in_flight[self._deliveries.pop(delivery)] -= 1
+
+    def call_soon_threadsafe(self, fn):
+        self._callbacks.put(fn)
+
+    def queue_depth(self, queue_name):
+        return self._queue(queue_name).qsize()
+
+    def _run_callbacks(self, timeout):
+        try:
+            fn = self._callbacks.get(timeout=timeout) if timeout else self._callbacks.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            fn()
+            try:
+                fn = self._callbacks.get_nowait()
+            except queue.Empty:
+                return
+
+    def _receive(self, index):
+        """ Deliver one message of a consumed queue, False if it is empty or at its prefetch"""
+        inbox, on_message, prefetch = self._consuming[index]
+        if self._in_flight[index] >= prefetch:
+            return False
+        try:
+            body = inbox.get_nowait()
+        except queue.Empty:
+            return False
+        # messages with headers are queued as (body, headers)
+        body, headers = body if isinstance(body, tuple) else (body, {})
+        try:
+            message = json.loads(body)
+        except ValueError as e:
+            print(f"Error parsing message: {e}")
+            return True
+        self._in_flight[index] += 1
+        self._delivery += 1
+        self._deliveries[self._delivery] = index
+        on_message(message, self._delivery, headers)
+        return True
+
+    def run(self):
+        """ Receive up to `prefetch` messages at a time per queue and run the completion callbacks"""
+        while not self._closed:
+            self._run_callbacks(timeout=None)
+            received = [self._receive(index) for index in range(len(self._consuming))]
+            if not any(received):
+                self._run_callbacks(timeout=LOCAL_POLL_INTERVAL)
+
+    def close(self):
+        self._closed = True
+
+    def put_raw(self, queue_name, bodies, headers=None):
+        """ Enqueue already serialized JSON bodies (used by the pump), with the
+        headers of each body when given"""
+        q = self._queue(queue_name)
+        for body, body_headers in zip(bodies, headers or [None] * len(bodies)):
+            q.put((body, body_headers) if body_headers else body)
+
+class LocalPublisher:
+    """ Pump-side publisher for the local backend (proxies are usable from any thread)"""
+
+    def __init__(self, queues):
+        self.queues = tuple(queues)
+        self._transport = None
+        self._lock = threading.Lock()
+
+    def _connected(self):
+        with self._lock:
+            if self._transport is None:
+                self._transport = LocalTransport()
+                for queue_name in self.queues:
+                    self._transport.declare(queue_name)
+            return self._transport
+
+    def publish(self, routing_key, body, properties=None, headers=None):
+        self._connected().put_raw(routing_key, [body], [headers])
+
+    def publish_batch(self, routing_key, bodies, properties=None, headers=None):
+        self._connected().put_raw(routing_key, bodies, headers)
+
+def connect(host=RABBITMQ_HOST, transport=None):
+    """ Open a consumer-side connection on the configured backend"""
+    transport = transport or TRANSPORT
+    if transport == 'rabbitmq':
+        return RabbitMQTransport(host)
+    if transport == 'local':
+        return LocalTransport()
+    raise ValueError(f"Unknown transport: {transport}")
+
+def make_publisher(queues, host=RABBITMQ_HOST, size=None, transport=None):
+    """ Pump-side publisher with publish(queue, body) / publish_batch(queue, bodies)"""
+    transport = transport or TRANSPORT
+    if transport == 'rabbitmq':
+        if size is None:
+            return PublisherPool(host=host, queues=queues)
+        return PublisherPool(host=host, queues=queues, size=size)
+    if transport == 'local':
+        return LocalPublisher(queues)
+    raise ValueError(f"Unknown transport: {transport}")
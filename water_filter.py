@@ -1,91 +1,162 @@
-import pika
-import json
 import os
 import sys
 import time
+import functools
 from PIL import Image, ImageDraw, ImageFont
+import consumer
+import transport
+import result_cache
+import metrics
+import shm_handoff
+import storage
+import strips
+import resize_filter
+import job_store
 
 #------configuration------
 RABBITMQ_HOST = 'localhost'
 IN_QUEUE = 'watermark_queue' #Queue to listen
-OUT_QUEUE = 'final_queue' #queue to publish for next filter
+OUT_QUEUE = job_store.FINAL_QUEUE #completion events, read by the pump's job store
 WATERMARK_FOLDER='./watermarked_images/'
 WATERMARK_TEXT= 'SDE Project'
+WATERMARK_FONT = 'arial.ttf' # falls back to Pillow's default font if missing
+WATERMARK_FONT_SIZE = 36
+WATERMARK_MARGIN = 10 # distance from the bottom right corner
+WATERMARK_WIDTHS = None # renditions to watermark (see RESIZE_WIDTHS), None for all of them
+# Concurrency of this filter process (see consumer.py)
+WORKER_COUNT = consumer.WORKER_COUNT
+WORKER_TYPE = consumer.WORKER_TYPE
+PREFETCH_COUNT = consumer.PREFETCH_COUNT
+METRICS_PORT = 9103 # http://localhost:9103/metrics
+MEMORY_BUDGET = consumer.WORKER_MEMORY_BUDGET # larger inputs are refused (checked on the header)
 # ensure folder exists
 os.makedirs(WATERMARK_FOLDER, exist_ok=True)
 #-------------------------
+def make_cache():
+    """ Results are memoized by (input content, parameters above). Called again when
+    the parameters are changed at start-up (see pipeline.py)"""
+    return result_cache.StageCache('watermark', {'text': WATERMARK_TEXT, 'font': WATERMARK_FONT,
+                                                 'font_size': WATERMARK_FONT_SIZE, 'margin': WATERMARK_MARGIN})
+
+cache = make_cache()
+
+@functools.lru_cache(maxsize=8)
+def load_font(font_path,font_size):
+    """ Load a font once per process, falls back to the default font"""
+    try:
+        return ImageFont.truetype(font_path, font_size)
+    except IOError:
+        print(f"Font {font_path} not found. Using default font.")
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=32)
+def watermark_tile(watermark_text,font_path,font_size):
+    """ Render the watermark text once into a small RGBA tile.
+    Returns the tile and the width/height of the text used for placement"""
+    font = load_font(font_path,font_size)
+    bbox = ImageDraw.Draw(Image.new('RGBA', (1,1))).textbbox((0, 0), watermark_text, font=font)
+    #Tile starts at the text origin so it lands exactly where d.text would draw it
+    tile = Image.new('RGBA', (max(bbox[2],1), max(bbox[3],1)), (255,255,255,0))
+    #Draw text with 50% opacity
+    ImageDraw.Draw(tile).text((0, 0), watermark_text, font=font, fill=(255,255,255,128))
+    return tile, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+def watermark(img,watermark_text,font_path=WATERMARK_FONT,font_size=WATERMARK_FONT_SIZE):
+    """ Add water mark to an in-memory image, returns an RGB image.
+    Only the region under the text is blended; an RGB input is modified in place"""
+    base = img if img.mode == 'RGB' else img.convert('RGB')
+    tile, text_width, text_height = watermark_tile(watermark_text,font_path,font_size)
+    #Calculate text position (bottom right corner)
+    pos_x = base.width - text_width - WATERMARK_MARGIN
+    pos_y = base.height - text_height - WATERMARK_MARGIN
+    #Clip the tile to the image for very small inputs
+    left, top = max(pos_x, 0), max(pos_y, 0)
+    right = min(pos_x + tile.width, base.width)
+    bottom = min(pos_y + tile.height, base.height)
+    if right <= left or bottom <= top:
+        return base
+    #Blend the tile into the bounding box only
+    region = base.crop((left, top, right, bottom)).convert('RGBA')
+    region.alpha_composite(tile, source=(left - pos_x, top - pos_y))
+    base.paste(region.convert('RGB'), (left, top))
+    return base
+
 def add_watermark(in_path,out_path,watermark_text):
     """ Add water mark to image"""
     try:
-        with Image.open(in_path).convert("RGBA") as base:
-            #Create transparent layer for text
-            txt = Image.new('RGBA', base.size, (255,255,255,0))
-            #Get a font need to provide a valid font path
-            #or use a default font
-            try:
-                font = ImageFont.truetype("arial.ttf", 36)
-            except IOError:
-                print("Arial font not found. Using default font.")
-                font = ImageFont.load_default()
-
-            #Get a drawing context
-            d = ImageDraw.Draw(txt)
-            #Calculate text position (bottom right corner)
-            bbox = d.textbbox((0, 0), watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            pos_x = base.width - text_width - 10
-            pos_y = base.height - text_height - 10
-            #Draw text with 50% opacity
-            d.text((pos_x, pos_y), watermark_text, font=font,fill=(255,255,255,128))
-            #Combine base image with text
-            watermarked = Image.alpha_composite(base, txt)
-            watermarked.convert("RGB").save(out_path)
+        with storage.open_image(in_path) as img:
+            with metrics.phase('decode'):
+                # an input that is not RGB is converted to an RGB copy
+                strips.check_budget(img, MEMORY_BUDGET, copies=2)
+                img.load()
+            with metrics.phase('transform'):
+                watermarked = watermark(img,watermark_text)
+            with metrics.phase('encode'):
+                storage.save_image(watermarked, out_path)
             print(f"Watermarked {in_path} saved to {out_path}")
             return True
     except Exception as e:
         print(f"Error adding watermark to image {in_path}: {e}")
         return False
-    
-def callback(ch,method, properties,body):
-    """ This function is called every time a message is received from IN_QUEUE """
-    print(f"\nReceived message..")
+
+def add_watermark_shared(ref,out_path,watermark_text):
+    """ Add water mark to pixels handed over in shared memory (nothing to decode)"""
+    def watermark_and_save(img):
+        with metrics.phase('transform'):
+            watermarked = watermark(img,watermark_text)
+        with metrics.phase('encode'):
+            storage.save_image(watermarked, out_path)
     try:
-        # 1. Parse the job message
-        message = json.loads(body)
-        image_id = message['image_id']
-        resized_path = message['resized_path']
-        print(f"Processing image_id: {image_id}, resized_path: {resized_path}")
-        # 2. Define the new output path
-        watermarked_path= os.path.join(WATERMARK_FOLDER,image_id)
-        # 3. Perform the work (the filter logic)
-        if add_watermark(resized_path,watermarked_path,WATERMARK_TEXT):
-            print(f"Watermark added successfully to {image_id}")
-        else:
-            print(f"Failed to add watermark to {image_id}")
-            
-        ch.basic_ack(delivery_tag=method.delivery_tag,)
-        print(f"Acknowledged message from {IN_QUEUE}")
+        shm_handoff.with_shared_image(ref, watermark_and_save)
+        print(f"Watermarked shared memory {ref['shm']} saved to {out_path}")
+        return True
     except Exception as e:
-        print(f"Error processing message: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)# need to discard bad message
-            
+        print(f"Error adding watermark to shared memory {ref['shm']}: {e}")
+        return False
+
+def watermark_rendition(rendition):
+    """ Watermark one rendition (a file or a shared memory segment), unless the
+    same input was already watermarked"""
+    watermarked_path= storage.path(WATERMARK_FOLDER,rendition['name'])
+    key = cache.key(result_cache.content_key(rendition, rendition.get('path')), watermarked_path)
+    if cache.fetch(key, watermarked_path):
+        print(f"Cache hit, reused watermarked image {rendition['name']}")
+        return True
+    if 'shared' in rendition:
+        ok = add_watermark_shared(rendition['shared'],watermarked_path,WATERMARK_TEXT)
+    else:
+        ok = add_watermark(rendition['path'],watermarked_path,WATERMARK_TEXT)
+    if ok:
+        cache.store(key, watermarked_path)
+    return ok
+
+def process(message):
+    """ Filter logic for one job, runs on a worker. This is the sink: it publishes
+    the completion event of the job"""
+    image_id = message['image_id']
+    selected = [r for r in resize_filter.job_renditions(message)
+                if WATERMARK_WIDTHS is None or 'width' not in r or r['width'] in WATERMARK_WIDTHS]
+    print(f"Processing image_id: {image_id}, {len(selected)} rendition(s)")
+    # Perform the work (the filter logic) on every configured size
+    failed = [r['name'] for r in selected if not watermark_rendition(r)]
+    if failed:
+        print(f"Failed to add watermark to {', '.join(failed)}")
+    else:
+        print(f"Watermark added successfully to {image_id}")
+    results = [{'name': r['name'], 'width': r.get('width'),
+                'path': storage.path(WATERMARK_FOLDER, r['name'])}
+               for r in selected if r['name'] not in failed]
+    return job_store.completion_event(image_id, results, failed, storage.intermediates(message))
 
 def main():
     # Connect to RabbitMQ
     print("Water Filter starting, Waiting for messages...")
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-        channel = connection.channel()
-    # Ensure the input queue exists
-        channel.queue_declare(queue=IN_QUEUE, durable=True)
-        print(f"Waiting for messages in {IN_QUEUE}. To exit press CTRL+C")
-    # Set up subscription on the queue
-        channel.basic_qos(prefetch_count=1)  # Fair dispatch
-        channel.basic_consume(queue=IN_QUEUE, on_message_callback=callback)
-        channel.start_consuming()
+        consumer.run_consumer(IN_QUEUE, OUT_QUEUE, process, host=RABBITMQ_HOST,
+                              prefetch=PREFETCH_COUNT, workers=WORKER_COUNT, worker_type=WORKER_TYPE,
+                              stage='watermark', metrics_port=METRICS_PORT)
     
-    except pika.exceptions.AMQPConnectionError:
+    except transport.CONNECTION_ERRORS:
         print("Interrupted could not connect to RabbitMQ server. Retrying in 5 seconds...")
         time.sleep(5)
         main()
@@ -94,4 +165,4 @@ def main():
         sys.exit(0)
         
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file